@@ -7,12 +7,12 @@ class CategorizeReviewsBeerStyles:
     def __init__(self, data_dir_path):
         """
         Script go generate the reviews_categorized.pkl file.
-        It represents the same dataframe as the generated reviews_df.csv file (which was generated in load_and_parse_beeradvocate_reviews.py) but with an extra column "general_style" which represents one of the 8 beer styles.
+        It represents the same dataframe as the generated reviews_df.parquet file (which was generated in load_and_parse_beeradvocate_reviews.py) but with an extra column "general_style" which represents one of the 8 beer styles.
 
         @param data_dir_path: path where the input files that are needed are stored.
         """
         self.users_path = data_dir_path / "BeerAdvocate" / "users.csv"
-        self.reviews_path = data_dir_path / "generated" / "reviews_df.csv"
+        self.reviews_path = data_dir_path / "generated" / "reviews_df.parquet"
         self.winners_path = data_dir_path / "generated" / "party_winners_over_years.csv"
 
     def generate_pickle(self, dst_path):
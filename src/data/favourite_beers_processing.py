@@ -1,6 +1,8 @@
 import pandas as pd
 import numpy as np
 
+from src.data.reviews_cube import OVERLAPPING_STATES
+
 #================================================================================================================================
 # .py script that contains Class for data processing to obtain favourite/top 3 favourite beer style according to average ratings.
 # Mostly used for data processing in us_states_visualization.ipynb
@@ -18,6 +20,20 @@ class FavouriteBeers():
         self.beer_preferences = beer_preferences
         self.year_list = list(np.arange(2004, 2017, 1, dtype=int))
         
+    @classmethod
+    def from_cube(cls, cube, all_states=True):
+        """
+        Initializes object of a class from the aggregate cube of the reviews (see Reviews.cube), without touching the reviews.
+        
+        Args:
+            @ param cube (ReviewsCube): Aggregate cube of the reviews.
+            @ param all_states (bool): Tells whether we need all states or only subset of them.
+        """
+        states = None if all_states else OVERLAPPING_STATES
+        beer_preferences = cube.average_ratings(list(np.arange(2004, 2017, 1, dtype=int)), states)
+        
+        return cls(beer_preferences)
+        
     def favbeer_process_for_mapplotting(self):
         """ Format beer ratings in adequate shape for plotting favourite beer of state for each year. """
     
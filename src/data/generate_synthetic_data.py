@@ -0,0 +1,241 @@
+import pathlib
+import sys
+
+import numpy as np
+import pandas as pd
+
+from src.data.load_and_parse_beeradvocate_reviews import FIELDS
+
+# Styles of the synthetic beers: styles of the BeerAdvocate dump, of every general style and of none (see reviews_processing)
+STYLES = ['American IPA', 'American Double / Imperial IPA', 'English India Pale Ale (IPA)', 'Belgian IPA',
+          'American Pale Ale (APA)', 'English Pale Ale', 'Belgian Pale Ale', 'American Amber / Red Ale', 'Irish Red Ale',
+          'American Brown Ale', 'Scotch Ale / Wee Heavy', 'American Blonde Ale', 'Saison / Farmhouse Ale',
+          'American Adjunct Lager', 'Euro Pale Lager', 'Vienna Lager', 'Munich Helles Lager', 'Light Lager',
+          'German Pilsener', 'Czech Pilsener', 'American Porter', 'Baltic Porter', 'English Porter',
+          'Russian Imperial Stout', 'American Stout', 'Milk / Sweet Stout', 'Oatmeal Stout', 'Irish Dry Stout',
+          'Witbier', 'Hefeweizen', 'Fruit / Vegetable Beer', 'Doppelbock', 'Extra Special / Strong Bitter (ESB)',
+          'Tripel', 'Dubbel', 'Kölsch']
+
+# States of the users, as in the locations of users.csv ('United States, <state>') and in the presidential data
+STATES = ['Alabama', 'Alaska', 'Arizona', 'Arkansas', 'California', 'Colorado', 'Connecticut', 'Delaware',
+          'District of Columbia', 'Florida', 'Georgia', 'Hawaii', 'Idaho', 'Illinois', 'Indiana', 'Iowa', 'Kansas',
+          'Kentucky', 'Louisiana', 'Maine', 'Maryland', 'Massachusetts', 'Michigan', 'Minnesota', 'Mississippi', 'Missouri',
+          'Montana', 'Nebraska', 'Nevada', 'New Hampshire', 'New Jersey', 'New Mexico', 'New York', 'North Carolina',
+          'North Dakota', 'Ohio', 'Oklahoma', 'Oregon', 'Pennsylvania', 'Rhode Island', 'South Carolina', 'South Dakota',
+          'Tennessee', 'Texas', 'Utah', 'Vermont', 'Virginia', 'Washington', 'West Virginia', 'Wisconsin', 'Wyoming']
+
+# Locations of the users outside US
+COUNTRIES = ['Canada', 'England', 'Germany', 'Belgium', 'Australia', 'Netherlands', 'Sweden']
+
+# Words of the review texts
+VOCABULARY = ['pours', 'a', 'hazy', 'golden', 'amber', 'dark', 'brown', 'black', 'color', 'with', 'thin', 'thick', 'white',
+              'tan', 'head', 'lacing', 'aroma', 'of', 'citrus', 'pine', 'grapefruit', 'caramel', 'toffee', 'bread',
+              'biscuit', 'roasted', 'malt', 'coffee', 'chocolate', 'hops', 'hoppy', 'bitter', 'sweet', 'dry', 'finish',
+              'taste', 'follows', 'the', 'nose', 'mouthfeel', 'is', 'medium', 'light', 'full', 'body', 'carbonation',
+              'smooth', 'creamy', 'crisp', 'clean', 'alcohol', 'well', 'hidden', 'drinkable', 'overall', 'nice', 'great',
+              'solid', 'not', 'bad', 'beer', 'bottle', 'glass', 'pint', 'and', 'but', 'very', 'bit', 'too', 'this']
+
+# Years of the presidential elections in party_winners_over_years.csv
+ELECTION_YEARS = [2004, 2008, 2012, 2016]
+
+# Reviews generated (and written) at once, also the unit of the random streams, so the output only depends on the seed
+CHUNK_REVIEWS = 100_000
+
+# Number of distinct review texts, reviews pick one of them (building a text per review would dominate the generation)
+N_TEXTS = 4096
+
+# Dates of the reviews and of the users joining (unix times, 2001 to mid 2017 like the dump)
+FIRST_DATE = 978_307_200
+LAST_DATE = 1_498_867_200
+
+
+class SyntheticBeerAdvocate:
+    """
+    Seeded generator of a synthetic BeerAdvocate dataset, in the formats of the real files: reviews.txt (see
+    load_and_parse_beeradvocate_reviews), users.csv, and the party_winners files of load_and_find_party_winners.
+    Beers have a fixed style and brewery, users a fixed location (mostly US states), and a few users write most of
+    the reviews. The same seed and sizes always give the same files, at any scale (reviews are streamed to disk).
+    """
+
+    def __init__(self, n_reviews, n_users=None, n_beers=None, seed=0):
+        """
+        Args:
+            @n_reviews (int): Number of reviews.
+            @n_users (int): Number of users, n_reviews / 20 (at least 100) if None.
+            @n_beers (int): Number of beers, n_reviews / 50 (at least 100) if None.
+            @seed (int): Seed of the generator.
+        """
+
+        self.n_reviews = n_reviews
+        self.n_users = n_users if n_users is not None else max(100, n_reviews // 20)
+        self.n_beers = n_beers if n_beers is not None else max(100, n_reviews // 50)
+        self.seed = seed
+
+        # Separate random streams for the users, beers, texts, party winners and each chunk of reviews
+        users_seed, beers_seed, texts_seed, winners_seed, self._reviews_seed = np.random.SeedSequence(seed).spawn(5)
+
+        # Users: heavy-tailed activity, join date, and location (US state, other country, or missing)
+        rng = np.random.default_rng(users_seed)
+        activity = rng.pareto(1.2, self.n_users) + 1
+        self.user_weights = activity / activity.sum()
+        self.user_joined = rng.integers(FIRST_DATE, LAST_DATE, self.n_users)
+        state_weights = rng.dirichlet(np.ones(len(STATES)))
+        locations = np.array([f"United States, {state}" for state in STATES] + COUNTRIES, dtype=object)
+        location_weights = np.concatenate([0.85 * state_weights, np.full(len(COUNTRIES), 0.15 / len(COUNTRIES))])
+        self.user_locations = locations[rng.choice(len(locations), self.n_users, p=location_weights)]
+        self.user_locations[rng.random(self.n_users) < 0.05] = np.nan
+
+        # Beers: style (every style has beers), brewery, abv and quality (mean rating)
+        rng = np.random.default_rng(beers_seed)
+        self.beer_styles = rng.permutation(np.arange(self.n_beers) % len(STYLES))
+        self.beer_breweries = rng.integers(0, max(10, self.n_beers // 10), self.n_beers)
+        self.beer_abvs = rng.uniform(3.5, 12.0, self.n_beers).round(1)
+        self.beer_quality = rng.normal(3.8, 0.35, self.n_beers)
+
+        # Texts: from a dozen to more than 500 words
+        rng = np.random.default_rng(texts_seed)
+        lengths = np.clip(rng.lognormal(4.5, 0.7, N_TEXTS).astype(int), 12, 600)
+        self.texts = [' '.join(rng.choice(VOCABULARY, length)) for length in lengths]
+
+        self._winners_seed = winners_seed
+
+    def iter_review_chunks(self):
+        """
+        Generates the reviews, CHUNK_REVIEWS at a time.
+
+        Returns:
+            @chunks (generator): DataFrames with the FIELDS columns.
+        """
+
+        chunk_seeds = self._reviews_seed.spawn((self.n_reviews + CHUNK_REVIEWS - 1) // CHUNK_REVIEWS)
+
+        for chunk_number, chunk_seed in enumerate(chunk_seeds):
+            rng = np.random.default_rng(chunk_seed)
+            n = min(CHUNK_REVIEWS, self.n_reviews - chunk_number * CHUNK_REVIEWS)
+
+            users = rng.choice(self.n_users, n, p=self.user_weights)
+            beers = rng.integers(0, self.n_beers, n)
+
+            # Reviews are written after the user joined
+            joined = self.user_joined[users]
+            dates = joined + (rng.random(n) * (LAST_DATE - joined)).astype(np.int64)
+
+            # Aspects in steps of 0.5 around the quality of the beer, rating in between
+            aspects = {aspect: np.clip(np.round(2 * rng.normal(self.beer_quality[beers], 0.5)) / 2, 1, 5)
+                       for aspect in ['appearance', 'aroma', 'palate', 'taste', 'overall']}
+            rating = (0.06 * aspects['appearance'] + 0.24 * aspects['aroma'] + 0.1 * aspects['palate']
+                      + 0.4 * aspects['taste'] + 0.2 * aspects['overall']).round(2)
+
+            yield pd.DataFrame({'beer_name': [f"Beer {beer}" for beer in beers],
+                                'beer_id': beers,
+                                'brewery_name': [f"Brewery {brewery}" for brewery in self.beer_breweries[beers]],
+                                'brewery_id': self.beer_breweries[beers],
+                                'style': np.array(STYLES, dtype=object)[self.beer_styles[beers]],
+                                'abv': self.beer_abvs[beers],
+                                'date': dates,
+                                'user_name': [f"user{user}" for user in users],
+                                'user_id': [f"user{user}.{user}" for user in users],
+                                **aspects,
+                                'rating': rating,
+                                'text': [self.texts[text] for text in rng.integers(0, N_TEXTS, n)]})
+
+    def write_reviews(self, dst_path):
+        """
+        Writes the reviews in the format of reviews.txt: one 'field: value' line per field, reviews separated by an empty line.
+
+        Args:
+            @dst_path (pathlib.Path): Where to write the reviews.
+
+        Returns:
+            @user_counts (np.ndarray): Number of reviews of each user.
+        """
+
+        user_counts = np.zeros(self.n_users, dtype=np.int64)
+
+        with open(dst_path, 'w', encoding='utf-8') as file:
+            for reviews_df in self.iter_review_chunks():
+                columns = [reviews_df[field].astype(str).tolist() for field in FIELDS]
+                file.writelines('\n'.join(f"{field}: {value}" for field, value in zip(FIELDS, values)) + '\n\n'
+                                for values in zip(*columns))
+
+                users = reviews_df['user_id'].str.split('.').str[-1].astype(np.int64)
+                user_counts += np.bincount(users, minlength=self.n_users)
+
+        return user_counts
+
+    def write_users(self, dst_path, user_counts=None):
+        """
+        Writes the users in the format of users.csv.
+
+        Args:
+            @dst_path (pathlib.Path): Where to write the users.
+            @user_counts (np.ndarray): Number of reviews of each user (from write_reviews), expected numbers if None.
+        """
+
+        if user_counts is None:
+            user_counts = np.round(self.user_weights * self.n_reviews).astype(np.int64)
+
+        users = np.arange(self.n_users)
+        users_df = pd.DataFrame({'nbr_ratings': user_counts,
+                                 'nbr_reviews': user_counts,
+                                 'user_id': [f"user{user}.{user}" for user in users],
+                                 'user_name': [f"user{user}" for user in users],
+                                 'joined': self.user_joined.astype(np.float64),
+                                 'location': self.user_locations})
+        users_df.to_csv(dst_path, index=False)
+
+    def write_party_winners(self, winners_path, winners_over_years_path):
+        """
+        Writes random election results, in the formats of party_winners.csv and party_winners_over_years.csv.
+
+        Args:
+            @winners_path (pathlib.Path): Where to write the status of each state (DEMOCRAT, REPUBLICAN or SWING).
+            @winners_over_years_path (pathlib.Path): Where to write the percentages of the parties and the winner per state and election year.
+        """
+
+        rng = np.random.default_rng(self._winners_seed)
+        n = len(STATES) * len(ELECTION_YEARS)
+
+        # Each state leans to a party, and moves a bit between elections
+        democrat = np.repeat(rng.uniform(33, 63, len(STATES)), len(ELECTION_YEARS)) + rng.normal(0, 3, n)
+        other = rng.uniform(0.5, 3, n)
+        libertarian = np.where(rng.random(n) < 0.6, rng.uniform(0.3, 3.5, n), np.nan)
+        over_years = pd.DataFrame({'state': np.repeat([state.upper() for state in STATES], len(ELECTION_YEARS)),
+                                   'year': np.tile(ELECTION_YEARS, len(STATES)),
+                                   'DEMOCRAT': democrat,
+                                   'LIBERTARIAN': libertarian,
+                                   'OTHER': other,
+                                   'REPUBLICAN': 100 - democrat - other - np.nan_to_num(libertarian)})
+        over_years['winner'] = np.where(over_years['DEMOCRAT'] > over_years['REPUBLICAN'], 'DEMOCRAT', 'REPUBLICAN')
+        over_years.to_csv(winners_over_years_path)
+
+        # Like PartyWinnersParser: a state that changed winner is a swing state
+        winners = over_years.groupby('state', sort=False)['winner'].agg(lambda winner: winner.iloc[0] if winner.nunique() == 1 else 'SWING')
+        pd.DataFrame({'state': winners.index.str.title(), 'party': winners.to_numpy()}).to_csv(winners_path)
+
+    def generate(self, data_dir_path):
+        """
+        Writes all the files, in the layout of the data directory: BeerAdvocate/reviews.txt, BeerAdvocate/users.csv,
+        generated/party_winners.csv and generated/party_winners_over_years.csv.
+
+        Args:
+            @data_dir_path (pathlib.Path): Data directory to write to.
+        """
+
+        data_dir_path = pathlib.Path(data_dir_path)
+        (data_dir_path / 'BeerAdvocate').mkdir(parents=True, exist_ok=True)
+        (data_dir_path / 'generated').mkdir(parents=True, exist_ok=True)
+
+        user_counts = self.write_reviews(data_dir_path / 'BeerAdvocate' / 'reviews.txt')
+        self.write_users(data_dir_path / 'BeerAdvocate' / 'users.csv', user_counts)
+        self.write_party_winners(data_dir_path / 'generated' / 'party_winners.csv',
+                                 data_dir_path / 'generated' / 'party_winners_over_years.csv')
+
+
+if __name__ == '__main__':
+    # Number of reviews and seed can be given on the command line
+    n_reviews = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    data_dir_path = pathlib.Path("../../data") / 'synthetic' / f"{n_reviews}_seed{seed}"
+
+    SyntheticBeerAdvocate(n_reviews, seed=seed).generate(data_dir_path)
@@ -1,6 +1,489 @@
+import bz2
+import collections
+import concurrent.futures
+import contextlib
+import gzip
+import hashlib
+import itertools
+import json
+import mmap
+import os
 import pathlib
+import queue
+import shutil
+import sys
+import tarfile
+import threading
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.data.reviews_schema import arrow_type, compact_dtypes, csv_dtypes
+from src.utils.instrumentation import INSTRUMENTATION
+
+# Size of the read buffer when streaming the reviews file
+READ_BUFFER_SIZE = 1 << 20
+
+# Size (in bytes) of the pieces of the reviews file that are parsed by each process in parallel mode
+PARALLEL_CHUNK_SIZE = 64 << 20
+
+# Memory used by each process of the parallel mode: parsing a piece takes about 7 times its size (5 with the numpy engine),
+# and up to two parsed pieces (each about the size of the piece) wait for the parent
+PARALLEL_MEMORY_PER_WORKER = 10 * PARALLEL_CHUNK_SIZE
+
+# Reviews are separated by an empty line
+RECORD_SEPARATOR = b'\n\n'
+
+# Compressed inputs are decompressed while they are parsed: a tar archive must contain one of these files
+ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2')
+ARCHIVE_MEMBERS = ['reviews.txt', 'reviews.txt.gz', 'reviews.txt.bz2']
+
+# Number of decompressed blocks (of READ_BUFFER_SIZE bytes) that are read ahead of the parser
+READ_AHEAD_BLOCKS = 16
+
+# The checkpoint of an output file (byte offset reached in the reviews file and hash of the parsed prefix)
+# is saved next to it, with this suffix
+CHECKPOINT_SUFFIX = '.checkpoint.json'
+
+# Components of a review, in the order in which they appear in reviews.txt
+FIELDS = ['beer_name', 'beer_id', 'brewery_name', 'brewery_id', 'style', 'abv', 'date', 'user_name', 'user_id',
+          'appearance', 'aroma', 'palate', 'taste', 'overall', 'rating', 'text']
+
+# Dispatch table of the record parser: field name -> position in the record
+FIELD_POSITIONS = {field: position for position, field in enumerate(FIELDS)}
+
+# A review without one of these (or with a non integer id / date) is malformed, any other missing field gets an empty value
+REQUIRED_FIELDS = ['beer_id', 'brewery_id', 'date', 'user_id']
+INTEGER_FIELDS = ['beer_id', 'brewery_id', 'date']
+
+# Lookup tables of the vectorized parsers: the first byte and the length of the name identify the field,
+# and the start of its line ('name: ') is stored as two little endian 8 bytes words (with the mask of the bytes that are used)
+FIELD_BY_NAME = np.full((max(len(field) for field in FIELDS) + 1, 256), -1, dtype=np.int8)
+FIELD_WORDS = np.zeros((len(FIELDS), 2), dtype='<u8')
+FIELD_MASKS = np.zeros((len(FIELDS), 2), dtype='<u8')
+for _index, _field in enumerate(FIELDS):
+    FIELD_BY_NAME[len(_field), ord(_field[0])] = _index
+    FIELD_WORDS[_index] = np.frombuffer(f"{_field}: ".encode().ljust(16, b'\0'), dtype='<u8')
+    FIELD_MASKS[_index] = np.frombuffer((b'\xff' * (len(_field) + 2)).ljust(16, b'\0'), dtype='<u8')
+
+# Typed schema of the columnar (.parquet) output, from the shared schema of review DFs: low cardinality names
+# are dictionary encoded, ids int32, scores float32 and the date stays in unix time
+REVIEWS_SCHEMA = pa.schema([(column, arrow_type(column)) for column in FIELDS + ['readable_date']])
+
+
+def parquet_files(reviews_path):
+    """
+    Files of parsed reviews saved as .parquet: the file itself, or the part files, in order, of a dataset directory
+    (what generate_result appends to incrementally).
+
+    Args:
+        reviews_path (pathlib.Path): Path to the parsed reviews (.parquet file or directory).
+
+    Return:
+        paths (list): Paths of the .parquet files, in the order of the reviews.
+    """
+
+    reviews_path = pathlib.Path(reviews_path)
+    if reviews_path.is_dir():
+        return sorted(reviews_path.glob('part-*.parquet'))
+    return [reviews_path]
+
+
+def reviews_columns(reviews_path):
+    """
+    Columns of the parsed reviews, in the order of the file, without loading them (the header is read).
+
+    Args:
+        reviews_path (pathlib.Path): Path to the parsed reviews.
+
+    Return:
+        columns (list): Names of the columns, None for a pickle (which can only be loaded whole).
+    """
+
+    suffix = pathlib.Path(reviews_path).suffix
+    if suffix == '.parquet':
+        return pq.read_schema(parquet_files(reviews_path)[0]).names
+    if suffix == '.csv':
+        return list(pd.read_csv(reviews_path, nrows=0).columns)
+    return None
+
+
+def _available_columns(reviews_path, columns, optional_columns):
+    """
+    Adds to columns the optional columns that the parsed reviews have (.parquet and .csv only, their header is read).
+    """
+
+    suffix = pathlib.Path(reviews_path).suffix
+    if columns is None or not optional_columns or suffix not in ('.parquet', '.csv'):
+        return columns
+
+    available = reviews_columns(reviews_path)
+
+    return list(dict.fromkeys(list(columns) + [column for column in optional_columns if column in available]))
+
+
+def load_reviews(reviews_path, columns=None, optional_columns=()):
+    """
+    Loads the parsed reviews, whatever the format they were saved in (.parquet file or directory, .csv or pickle).
+
+    Args:
+        reviews_path (pathlib.Path): Path to the parsed reviews.
+        columns (list): Columns to load, all of them if None.
+        optional_columns (list): Columns to load as well if the file has them (e.g. sentiment_label, which only
+            the reviews with sentiment have).
+
+    Return:
+        reviews_df (pd.DataFrame): DF with the reviews, with the compact types of reviews_schema.
+    """
+
+    suffix = pathlib.Path(reviews_path).suffix
+    columns = _available_columns(reviews_path, columns, optional_columns)
+
+    if suffix == '.parquet':
+        # Typed columns, only the requested ones are read from disk (all the part files of a directory, in order),
+        # dates as datetime64 rather than Python date objects
+        reviews_df = pd.read_parquet(reviews_path, columns=columns, to_pandas_kwargs={'date_as_object': False})
+    elif suffix == '.csv':
+        reviews_df = pd.read_csv(reviews_path, usecols=columns, dtype=csv_dtypes())
+    else:
+        reviews_df = pd.read_pickle(reviews_path)
+        if columns is not None:
+            columns = list(dict.fromkeys(list(columns) + [column for column in optional_columns if column in reviews_df]))
+            reviews_df = reviews_df[columns]
+
+    return compact_dtypes(reviews_df)
+
+
+def iter_review_chunks(reviews_path, columns=None, chunk_size=1_000_000, optional_columns=()):
+    """
+    Loads the parsed reviews chunk by chunk, so that only chunk_size reviews are in memory at once
+    (a pickle can only be loaded whole, it is then cut into chunks).
+
+    Args:
+        reviews_path (pathlib.Path): Path to the parsed reviews.
+        columns (list): Columns to load, all of them if None.
+        chunk_size (int): Number of reviews per chunk.
+        optional_columns (list): Columns to load as well if the file has them.
+
+    Yields:
+        reviews_df (pd.DataFrame): Next chunk of reviews, with the compact types of reviews_schema.
+    """
+
+    suffix = pathlib.Path(reviews_path).suffix
+    columns = _available_columns(reviews_path, columns, optional_columns)
+
+    if suffix == '.parquet':
+        for path in parquet_files(reviews_path):
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+                yield compact_dtypes(batch.to_pandas(date_as_object=False))
+    elif suffix == '.csv':
+        with pd.read_csv(reviews_path, usecols=columns, dtype=csv_dtypes(), chunksize=chunk_size) as chunks:
+            for reviews_df in chunks:
+                yield compact_dtypes(reviews_df)
+    else:
+        reviews_df = load_reviews(reviews_path, columns, optional_columns)
+        for start in range(0, len(reviews_df), chunk_size):
+            yield reviews_df.iloc[start:start + chunk_size]
+
+
+def is_compressed(src_path):
+    """
+    Tells whether the reviews file is compressed (.gz, .bz2 or a tar archive), i.e. can only be read as a stream.
+    """
+
+    return str(src_path).endswith(('.gz', '.bz2') + ARCHIVE_SUFFIXES)
+
+
+def _decompressed(file, name):
+    """
+    Wraps an open binary file in the decompressor that matches its name (the file itself if it is not compressed).
+    """
+
+    if name.endswith('.gz'):
+        return gzip.GzipFile(fileobj=file, mode='rb')
+    if name.endswith('.bz2'):
+        return bz2.BZ2File(file, mode='rb')
+    return file
+
+
+@contextlib.contextmanager
+def open_reviews(src_path):
+    """
+    Opens the reviews file as a binary stream, decompressing it on the fly if it is compressed: reviews.txt.gz,
+    reviews.txt.bz2, or a (compressed) tar archive such as BeerAdvocate.tar.gz with one of ARCHIVE_MEMBERS in it.
+    Nothing is extracted to disk.
+
+    Args:
+        src_path (pathlib.Path): Path of the file with reviews.
+
+    Yields:
+        file (file object): Binary file with the (decompressed) content of reviews.txt.
+    """
+
+    with contextlib.ExitStack() as stack:
+        if str(src_path).endswith(ARCHIVE_SUFFIXES):
+            # Streaming mode: members are read in the order of the archive, without seeking
+            archive = stack.enter_context(tarfile.open(src_path, mode='r|*'))
+            for member in archive:
+                if member.isfile() and pathlib.PurePosixPath(member.name).name in ARCHIVE_MEMBERS:
+                    file = _decompressed(stack.enter_context(archive.extractfile(member)), member.name)
+                    break
+            else:
+                raise FileNotFoundError(f"{src_path} does not contain any of {ARCHIVE_MEMBERS}")
+        else:
+            file = _decompressed(stack.enter_context(open(src_path, 'rb', buffering=READ_BUFFER_SIZE)), str(src_path))
+
+        yield stack.enter_context(file)
+
+
+def _read_ahead(src_path):
+    """
+    Reads the (decompressed) reviews file block by block in a background thread, a bounded number of blocks ahead
+    of the consumer. zlib and bz2 release the GIL, so decompression runs while the consumer parses.
+
+    Yields:
+        block (bytes): Next block of the decompressed file.
+    """
+
+    blocks = queue.Queue(maxsize=READ_AHEAD_BLOCKS)
+    stop = threading.Event()
+
+    def put(item):
+        # Give up when the consumer is gone, instead of waiting forever on a full queue
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read():
+        try:
+            with open_reviews(src_path) as file:
+                while not stop.is_set():
+                    block = file.read(READ_BUFFER_SIZE)
+                    put(block)
+                    if not block:
+                        break
+        except Exception as error:
+            put(error)
+
+    thread = threading.Thread(target=read, daemon=True)
+    thread.start()
+    try:
+        while True:
+            block = blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                break
+            yield block
+    finally:
+        stop.set()
+        thread.join()
+
+
+def iter_record_chunks(src_path, chunk_size=PARALLEL_CHUNK_SIZE):
+    """
+    Streams the (possibly compressed) reviews file as pieces of roughly chunk_size decompressed bytes that end
+    on review boundaries, so that they can be parsed while the rest of the file is being decompressed.
+
+    Args:
+        src_path (pathlib.Path): Path of the file with reviews.
+        chunk_size (int): Approximate size of each piece in bytes.
+
+    Yields:
+        content (bytes): Next piece of the file.
+    """
+
+    pending = bytearray()
+    for block in _read_ahead(src_path):
+        pending += block
+        if len(pending) >= chunk_size:
+            # Cut right after the last record separator, the rest goes with the next piece
+            cut = pending.rfind(RECORD_SEPARATOR)
+            if cut >= 0:
+                cut += len(RECORD_SEPARATOR)
+                yield bytes(pending[:cut])
+                del pending[:cut]
+
+    if pending:
+        yield bytes(pending)
+
+
+def file_prefix_hashes(src_path, offsets):
+    """
+    Hashes the first bytes of a file, for several prefix lengths at once (the file is read only once).
+
+    Args:
+        src_path (pathlib.Path): Path of the file.
+        offsets (list): Lengths of the prefixes to hash, in increasing order.
+
+    Return:
+        hashes (list): Hex digest (blake2b) of each prefix.
+    """
+
+    digest = hashlib.blake2b()
+    hashes = []
+    position = 0
+
+    with open(src_path, 'rb') as file:
+        for offset in offsets:
+            while position < offset:
+                block = file.read(min(READ_BUFFER_SIZE, offset - position))
+                if not block:
+                    break
+                digest.update(block)
+                position += len(block)
+            hashes.append(digest.copy().hexdigest())
+
+    return hashes
+
+
+def record_aligned_ranges(src_path, chunk_size=PARALLEL_CHUNK_SIZE, start=0, end=None):
+    """
+    Cuts the reviews file into byte ranges of roughly chunk_size bytes that start and end on review boundaries.
+
+    Args:
+        src_path (pathlib.Path): Path of the file with reviews.
+        chunk_size (int): Approximate size of each range in bytes.
+        start (int): Offset where to start (must be a review boundary).
+        end (int): Offset where to stop, the end of the file if None.
+
+    Return:
+        ranges (list): List of (start, end) byte offsets, covering [start, end) of the file in order.
+    """
+
+    file_size = os.path.getsize(src_path) if end is None else end
+    ranges = []
+
+    with open(src_path, 'rb') as file:
+        while start < file_size:
+            end = min(start + chunk_size, file_size)
+
+            # Move the end forward, right after the next record separator
+            file.seek(end)
+            tail = b''
+            while end < file_size:
+                block = file.read(READ_BUFFER_SIZE)
+                position = (tail + block).find(RECORD_SEPARATOR)
+                if position >= 0:
+                    end = end - len(tail) + position + len(RECORD_SEPARATOR)
+                    break
+                end += len(block)
+                tail = block[-1:]
+            end = min(end, file_size)
+
+            ranges.append((start, end))
+            start = end
+
+    return ranges
+
+
+def parallel_workers(n_workers, memory_budget=None):
+    """
+    Number of processes of the parallel mode: n_workers, capped so that their pieces fit in the memory budget
+    (see PARALLEL_MEMORY_PER_WORKER), e.g. n_workers=os.cpu_count() on a machine with many cores and little memory.
+
+    Args:
+        n_workers (int): Number of processes asked for.
+        memory_budget (int): Memory (in bytes) the parallel mode may use, half of the physical memory if None
+            (4 GB if it is unknown).
+
+    Return:
+        n_workers (int): Number of processes to use (at least 1).
+    """
+
+    if memory_budget is None:
+        try:
+            memory_budget = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+        except (AttributeError, ValueError, OSError):
+            memory_budget = 4 << 30
+
+    return max(1, min(n_workers, memory_budget // PARALLEL_MEMORY_PER_WORKER))
+
+
+def map_parallel(function, tasks, n_workers, initializer=None, initargs=()):
+    """
+    Runs function on each tuple of arguments of tasks in a process pool and yields the results in the order of tasks.
+    Only a bounded number of tasks is in flight, so tasks can be a lazy iterator over a large input.
+
+    Args:
+        function (callable): Function to run (must be picklable, i.e. defined at module level).
+        tasks (iterable): Tuples of arguments of function.
+        n_workers (int): Number of processes.
+        initializer (callable): Function run once in each process before the tasks (e.g. to set data shared by all the tasks,
+            which is then sent once per process instead of once per task).
+        initargs (tuple): Arguments of initializer.
+
+    Yields:
+        result: Result of function for the next task.
+    """
+
+    tasks = iter(tasks)
+    in_flight = collections.deque()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers, initializer=initializer, initargs=initargs) as executor:
+        while True:
+            # Keep every worker busy, plus one task waiting
+            for arguments in itertools.islice(tasks, 2 * n_workers - len(in_flight)):
+                in_flight.append(executor.submit(function, *arguments))
+            if not in_flight:
+                break
+
+            yield in_flight.popleft().result()
+
+
+def _parse_range(src_path, start, end, engine='python'):
+    """
+    Parses the reviews in bytes [start, end) of the file (worker of the parallel mode).
+    The 'numpy' engine memory-maps the file instead of reading the range.
+
+    Return:
+        review_df (pd.DataFrame): DF with the reviews of this range (index starting from 0).
+        quarantine (list): Raw text of the malformed reviews of this range.
+    """
+
+    parser = BeerAdvocateParser()
+    quarantine = []
+
+    if engine == 'numpy':
+        with open(src_path, 'rb') as file:
+            if end == start:
+                return parser._to_dataframe(parser._parse_rows([])), quarantine
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                buffer = np.frombuffer(mapped, dtype=np.uint8, count=end - start, offset=start)
+                dictionary = parser._parse_buffer(buffer, quarantine)
+                del buffer
+        return parser._to_dataframe(dictionary), quarantine
+
+    with open(src_path, 'rb') as file:
+        file.seek(start)
+        content = file.read(end - start)
+
+    return _parse_chunk(content, engine)
+
+
+def _parse_chunk(content, engine='python'):
+    """
+    Parses the reviews of a piece of the file that was already read (worker of the streaming mode).
+
+    Return:
+        review_df (pd.DataFrame): DF with the reviews of this piece (index starting from 0).
+        quarantine (list): Raw text of the malformed reviews of this piece.
+    """
+
+    parser = BeerAdvocateParser()
+    quarantine = []
+
+    if engine == 'numpy':
+        dictionary = parser._parse_buffer(np.frombuffer(content, dtype=np.uint8), quarantine)
+    else:
+        dictionary = parser._parse_rows(parser._split_rows(content), quarantine)
+
+    return parser._to_dataframe(dictionary), quarantine
 
 
 class BeerAdvocateParser:
@@ -8,6 +491,10 @@ class BeerAdvocateParser:
     Class for parsing the beer advocate txt file with reviews into pandas DF (saved as .csv)
     """
 
+    def __init__(self):
+        # Number of malformed reviews found by the last parse
+        self.n_quarantined = 0
+
     def _parse_reviews(self, content):
         """
         Parses all the reviews to dictionary.
@@ -22,126 +509,565 @@ class BeerAdvocateParser:
         # By looking at the data we can observe that each review is separated by double newline \n\n
         rows = content.strip().split('\n\n')
 
+        return self._parse_rows(row.split('\n') for row in rows)
+
+    def _parse_rows(self, rows, quarantine=None):
+        """
+        Parses reviews given as lists of lines into a dictionary of columns, one whole review at a time.
+        Each line is dispatched on its field name (FIELD_POSITIONS) into the slots of the current review, so a missing
+        line can never shift the values of the following reviews. Missing optional fields are left empty, and malformed
+        reviews (missing or non integer id / date, repeated field) are skipped.
+
+        Args:
+            rows (iterable): Each entry is one review, given as the list of its lines.
+            quarantine (list): If given, the raw text of each malformed review is appended to it.
+
+        Return:
+            dictionary (dict): All the reviews stored in the dictionary (each component of the the review is one key).
+        """
+
         # Create dictionary out of these reviews that will be turned into pandas DF
         # Each lists stores one component of the review, for each reviewer
-        beer_name = []
-        beer_id = []
-        brewery_name = []
-        brewery_id = []
-        style = []
-        abv = []
-        date = []
-        user_name = []
-        user_id = []
-        appearance = []
-        aroma = []
-        palate = []
-        taste = []
-        overall = []
-        rating = []
-        text = []
-
-        for row in rows:
-
-            review = row.split('\n')
-            # print(review)
+        columns = [[] for _ in FIELDS]
+
+        for review in rows:
+            values = [None] * len(FIELDS)
+            malformed = False
+
             for element in review:
-                # Append beer name
-                if element.startswith('beer_name'):
-                    beer_name.append(element.split(': ')[1])
-                # Append beer_id
-                elif element.startswith('beer_id'):
-                    beer_id.append(element.split(': ')[1])
-                # Append brewery_name
-                elif element.startswith('brewery_name'):
-                    brewery_name.append(element.split(': ')[1])
-                # Append brewery_id
-                elif element.startswith('brewery_id'):
-                    brewery_id.append(element.split(': ')[1])
-                # Append style
-                elif element.startswith('style'):
-                    style.append(element.split(': ')[1])
-                # Append abv
-                elif element.startswith('abv'):
-                    abv.append(element.split(': ')[1])
-                # Append date
-                elif element.startswith('date'):
-                    date.append(element.split(': ')[1])
-                # Append user_name
-                elif element.startswith('user_name'):
-                    user_name.append(element.split(': ')[1])
-                # Append user_id
-                elif element.startswith('user_id'):
-                    user_id.append(element.split(': ')[1])
-                # Append appearance
-                elif element.startswith('appearance'):
-                    appearance.append(element.split(': ')[1])
-                # Append aroma
-                elif element.startswith('aroma'):
-                    aroma.append(element.split(': ')[1])
-                # Append palate
-                elif element.startswith('palate'):
-                    palate.append(element.split(': ')[1])
-                # Append taste
-                elif element.startswith('taste'):
-                    taste.append(element.split(': ')[1])
-                # Append overall
-                elif element.startswith('overall'):
-                    overall.append(element.split(': ')[1])
-                # Append rating
-                elif element.startswith('rating'):
-                    rating.append(element.split(': ')[1])
-                # Append text
-                elif element.startswith('text'):
-                    text.append(element.split(': ')[1])
-
-        dictionary = {'beer_name': beer_name,
-                      'beer_id': beer_id,
-                      'brewery_name': brewery_name,
-                      'brewery_id': brewery_id,
-                      'style': style,
-                      'abv': abv,
-                      'date': date,
-                      'user_name': user_name,
-                      'user_id': user_id,
-                      'appearance': appearance,
-                      'aroma': aroma,
-                      'palate': palate,
-                      'taste': taste,
-                      'overall': overall,
-                      'rating': rating,
-                      'text': text}
+                name = element.split(':', 1)[0]
+                position = FIELD_POSITIONS.get(name)
+                if position is None:
+                    # Not a component of the review (e.g. empty line)
+                    continue
+                if values[position] is not None:
+                    malformed = True
+                    break
+
+                parts = element.split(': ')
+                values[position] = parts[1] if len(parts) > 1 else ''
+
+            for field in REQUIRED_FIELDS:
+                value = values[FIELD_POSITIONS[field]]
+                if not value or (field in INTEGER_FIELDS and not (value.isascii() and value.isdigit())):
+                    malformed = True
+
+            if malformed:
+                if quarantine is not None:
+                    quarantine.append('\n'.join(review))
+                continue
+
+            for column, value in zip(columns, values):
+                column.append('' if value is None else value)
+
+        dictionary = dict(zip(FIELDS, columns))
 
         return dictionary
 
-    def generate_result(self, src_path, dst_path):
+    def _split_rows(self, buffer):
         """
-        Generate the result of parsing the reviews into a pandas DF and save it as a .csv file.
-        @param src_path: path of the file with reviews to parse
-        @param dst_path: path where to save the .csv file with the parsed reviews
+        Splits raw bytes of whole reviews into reviews, given as lists of lines (like _parse_reviews does with a string).
+        """
+
+        content = bytes(buffer).decode('utf-8')
+
+        # Only strip newlines: a trailing space belongs to an empty 'text: ' field of the last review
+        rows = content.strip('\n').split('\n\n') if content.strip() else []
+
+        return [row.split('\n') for row in rows]
+
+    def _parse_buffer(self, buffer, quarantine=None):
+        """
+        Vectorized version of _parse_rows working directly on the raw bytes of the reviews (e.g. a memory-mapped file).
+        Field names and value spans are located for all lines at once with NumPy, and the values are copied from the buffer
+        straight into Arrow string columns, without a Python string per value.
+        Reviews that are exactly all the fields in order, one 'field: value' line each, with valid ids / dates, are parsed
+        this way. Any other review (missing or unknown line, malformed review, ...) is handed over to _parse_rows on its own
+        and put back in its place, so the result is the same as _parse_rows on the decoded lines (including the
+        split(': ')[1] semantics).
+
+        Args:
+            buffer (np.ndarray or bytes): Raw bytes (uint8) of whole reviews.
+            quarantine (list): If given, the raw text of each malformed review is appended to it (see _parse_rows).
+
+        Return:
+            dictionary (dict): All the reviews stored in the dictionary (each component of the the review is one key,
+                with a pd.Series of strings).
+        """
+
+        data = np.frombuffer(buffer, dtype=np.uint8)
+        size = len(data)
+        if size < 16:
+            return self._parse_rows(self._split_rows(buffer), quarantine)
+
+        # Start and end (exclusive, without the newline) of every non empty line, and the review it belongs to
+        # (reviews are separated by empty lines)
+        newlines = np.flatnonzero(data == ord('\n'))
+        line_starts = np.concatenate(([0], newlines + 1))
+        line_ends = np.concatenate((newlines, [size]))
+        empty = line_ends == line_starts
+        lines = np.flatnonzero(~empty)
+        starts_review = np.concatenate(([True], empty[:-1]))[lines]
+        line_starts, line_ends = line_starts[lines], line_ends[lines]
+        review_first = np.flatnonzero(starts_review)
+        review_ends = line_ends[np.append(review_first[1:], len(lines)) - 1]
+
+        # Regular reviews are made of all the fields in order, one per line: the line of each field must start with
+        # 'name: ', which is checked 8 bytes at a time (read through an overlapping view of the buffer, the reviews that
+        # end too close to the end of the buffer for it are left to the review by review parser)
+        fast = np.diff(np.append(review_first, len(lines))) == len(FIELDS)
+        fast[fast] = line_starts[review_first[fast] + len(FIELDS) - 1] + 16 <= size
+        value_lines = review_first[fast][:, None] + np.arange(len(FIELDS))
+        words = np.ndarray(shape=(size - 7,), dtype='<u8', buffer=data, strides=(1,))
+        long_names = np.flatnonzero(FIELD_MASKS[:, 1])
+        name_starts = line_starts[value_lines]
+        regular = np.all((words[name_starts] & FIELD_MASKS[:, 0]) == FIELD_WORDS[:, 0], axis=1)
+        regular &= np.all((words[name_starts[:, long_names] + 8] & FIELD_MASKS[long_names, 1]) == FIELD_WORDS[long_names, 1], axis=1)
+        fast[np.flatnonzero(fast)[~regular]] = False
+        value_lines = value_lines[regular]
+
+        # The value is what is between the first ': ' (the end of the name) and the second one, if any, or the end of the line
+        value_starts = name_starts[regular] + np.array([len(field) + 2 for field in FIELDS])
+        value_ends = line_ends[value_lines]
+        colons = np.flatnonzero(data[:-1] == ord(':'))
+        separators = colons[data[colons + 1] == ord(' ')]
+        if len(separators) > value_starts.size:
+            # Separators that are not the end of a name shorten the value they are in, if any
+            name_ends = value_starts.ravel() - 2
+            positions = np.searchsorted(name_ends, separators).clip(max=max(len(name_ends) - 1, 0))
+            extra = separators[name_ends[positions] != separators] if len(name_ends) else separators
+            in_value = np.searchsorted(value_starts.ravel(), extra, side='right') - 1
+            extra, in_value = extra[in_value >= 0], in_value[in_value >= 0]
+            value_ends = value_ends.ravel()
+            inside = extra < value_ends[in_value]
+            np.minimum.at(value_ends, in_value[inside], extra[inside])
+            value_ends = value_ends.reshape(value_starts.shape)
+
+        # Required fields must not be empty and ids / dates must be integers (their digits are checked once copied below),
+        # otherwise the review by review parser quarantines the review
+        lengths = value_ends - value_starts
+        valid = np.all(lengths[:, [FIELD_POSITIONS[field] for field in REQUIRED_FIELDS]] > 0, axis=1)
+        valid &= np.all(lengths[:, [FIELD_POSITIONS[field] for field in INTEGER_FIELDS]] <= 18, axis=1)
+        n_fast = len(value_starts)
+
+        # Values of the short fields, column after column, copied with one vectorized gather of their bytes
+        index_type = np.int32 if size < 1 << 31 else np.int64
+        short_fields = [FIELD_POSITIONS[field] for field in FIELDS if field != 'text']
+        short_lengths = lengths[:, short_fields].T.ravel()
+        short_offsets = np.concatenate(([0], np.cumsum(short_lengths)))
+        positions = np.repeat((value_starts[:, short_fields].T.ravel() - short_offsets[:-1]).astype(index_type), short_lengths)
+        positions += np.arange(short_offsets[-1], dtype=index_type)
+        short_values = data[positions]
+
+        for field in INTEGER_FIELDS:
+            column = short_fields.index(FIELD_POSITIONS[field])
+            column_offsets = short_offsets[column * n_fast:(column + 1) * n_fast + 1]
+            column_values = short_values[column_offsets[0]:column_offsets[-1]]
+            not_digits = np.flatnonzero((column_values < ord('0')) | (column_values > ord('9'))) + column_offsets[0]
+            valid[np.searchsorted(column_offsets, not_digits, side='right') - 1] = False
+
+        # Texts (most of the bytes) are copied slice by slice
+        memory = memoryview(data)
+        text = FIELD_POSITIONS['text']
+        text_values = b''.join([memory[start:end] for start, end in zip(value_starts[:, text].tolist(), value_ends[:, text].tolist())])
+        text_offsets = np.concatenate(([0], np.cumsum(lengths[:, text])))
+
+        # String columns over the copied values (checked to be valid UTF-8, like decoding them)
+        columns = [None] * len(FIELDS)
+        for column, field_index in enumerate(short_fields):
+            offsets = pa.py_buffer(short_offsets[column * n_fast:(column + 1) * n_fast + 1])
+            columns[field_index] = pa.LargeStringArray.from_buffers(n_fast, offsets, pa.py_buffer(short_values))
+        columns[text] = pa.LargeStringArray.from_buffers(n_fast, pa.py_buffer(text_offsets), pa.py_buffer(text_values))
+        for column in columns:
+            column.validate(full=True)
+
+        if not valid.all():
+            fast[np.flatnonzero(fast)[~valid]] = False
+            columns = [column.filter(valid) for column in columns]
+
+        # The other reviews, review by review (the parsed ones are put back in the order of the file)
+        slow_reviews, slow_columns = [], [[] for _ in FIELDS]
+        for review in np.flatnonzero(~fast).tolist():
+            raw_review = bytes(data[line_starts[review_first[review]]:review_ends[review]]).decode('utf-8')
+            dictionary = self._parse_rows([raw_review.split('\n')], quarantine)
+            if dictionary['user_id']:
+                slow_reviews.append(review)
+                for column, field in zip(slow_columns, FIELDS):
+                    column.extend(dictionary[field])
+        order = np.argsort(np.concatenate([np.flatnonzero(fast), slow_reviews]), kind='stable') if slow_reviews else None
+
+        dictionary = {}
+        for field_index, field in enumerate(FIELDS):
+            column = columns[field_index]
+            if order is not None:
+                column = pa.concat_arrays([column, pa.array(slow_columns[field_index], pa.large_string())]).take(order)
+            dictionary[field] = column.to_pandas()
+
+        return dictionary
+
+    def _iter_records(self, file, limit=None):
+        """
+        Lazily splits an open (binary) reviews file into reviews, one line at a time.
+
+        Args:
+            file (file object): Buffered binary file with the reviews.
+            limit (int): Number of bytes to read at most, until the end of the file if None.
+
+        Yields:
+            review (list): Lines (str) of one review, without the trailing newline.
+        """
+
+        lines = []
+        consumed = 0
+        for line in file:
+            if limit is not None:
+                # Do not read what was appended to the file after the parse started
+                line = line[:limit - consumed]
+                consumed += len(line)
+                if not line:
+                    break
+            line = line.rstrip(b'\n')
+
+            # Empty line marks the end of a review
+            if line:
+                lines.append(line.decode('utf-8'))
+            elif lines:
+                yield lines
+                lines = []
+
+        # Last review is not necessarily followed by an empty line
+        if lines:
+            yield lines
+
+    def iter_reviews(self, src_path):
+        """
+        Generator mode of the parser: yields the reviews one at a time, without ever reading the whole file.
+        Malformed reviews are skipped.
+
+        Args:
+            src_path (pathlib.Path): Path of the file with reviews to parse.
+
+        Yields:
+            review (dict): One parsed review (each component of the review is one key).
+        """
+
+        with open_reviews(src_path) as file:
+            for review in self._iter_records(file):
+                dictionary = self._parse_rows([review])
+                if dictionary['user_id']:
+                    yield {key: values[0] for key, values in dictionary.items()}
+
+    def iter_batches(self, src_path, batch_size=100_000, n_workers=1, engine='python', quarantine_path=None,
+                     start=0, end=None):
+        """
+        Parses the reviews file into pandas DFs of at most batch_size rows, so only one batch is held in memory.
+        With n_workers > 1 or engine='numpy', the file is cut into byte ranges on review boundaries that are parsed
+        (by a pool of processes if n_workers > 1), and each range is yielded as one DF (in the original order of the file).
+        A compressed file (see open_reviews) is decompressed in a background thread and parsed piece by piece
+        as it is decompressed, one DF per piece.
+
+        Args:
+            src_path (pathlib.Path): Path of the file with reviews to parse.
+            batch_size (int): Number of reviews per DF (sequential python engine only).
+            n_workers (int): Number of processes used for parsing (capped by the memory budget, see parallel_workers).
+            engine (str): 'python' parses line by line, 'numpy' parses the memory-mapped bytes with vectorized operations.
+            quarantine_path (pathlib.Path): If given, malformed reviews are written there (in the reviews.txt format)
+                as they are found, instead of being dropped (appended to it when start > 0).
+            start (int): Byte offset where to start parsing (must be a review boundary, e.g. a checkpoint).
+            end (int): Byte offset where to stop parsing, the current end of the file if None.
+                start and end are ignored for a compressed file, which is always parsed whole.
+
+        Yields:
+            review_df (pd.DataFrame): Parsed reviews, index continues from the previous batch.
         """
 
-        # Read the entire file as a string
-        with open(src_path, 'r') as file:
-            content = file.read()
+        n_workers = parallel_workers(n_workers)
+        compressed = is_compressed(src_path)
+        if compressed:
+            start, end = 0, None
+        elif end is None:
+            end = os.path.getsize(src_path)
+
+        quarantine_mode = 'a' if start else 'w'
+        quarantine_file = open(quarantine_path, quarantine_mode, encoding='utf-8') if quarantine_path is not None else None
+        try:
+            if compressed:
+                batches = self._iter_batches_stream(src_path, n_workers, engine)
+            elif n_workers > 1 or engine == 'numpy':
+                batches = self._iter_batches_ranges(src_path, n_workers, engine, start, end)
+            else:
+                batches = self._iter_batches_records(src_path, batch_size, start, end)
+
+            for review_df, quarantine in batches:
+                self.n_quarantined += len(quarantine)
+                if quarantine_file is not None:
+                    quarantine_file.writelines(review + '\n\n' for review in quarantine)
+                yield review_df
+        finally:
+            if quarantine_file is not None:
+                quarantine_file.close()
+
+    def _iter_batches_records(self, src_path, batch_size, start, end):
+        """
+        Sequential mode of iter_batches: bytes [start, end) of the file are read review by review, batch_size reviews
+        at a time. Yields (review_df, quarantine) pairs.
+        """
+
+        index = 0
+        with open(src_path, 'rb', buffering=READ_BUFFER_SIZE) as file:
+            file.seek(start)
+            records = self._iter_records(file, end - start)
+            while True:
+                batch = list(itertools.islice(records, batch_size))
+                if not batch:
+                    break
+
+                quarantine = []
+                review_df = self._to_dataframe(self._parse_rows(batch, quarantine), index)
+                index += len(review_df)
+                yield review_df, quarantine
+
+    def _iter_batches_ranges(self, src_path, n_workers, engine, start, end):
+        """
+        Range mode of iter_batches: ranges of the file are parsed (in a process pool if n_workers > 1) and merged in order.
+        Only 2 * n_workers ranges are in flight, so memory stays proportional to n_workers * PARALLEL_CHUNK_SIZE
+        (see PARALLEL_MEMORY_PER_WORKER).
+        Yields (review_df, quarantine) pairs.
+        """
+
+        ranges = record_aligned_ranges(src_path, PARALLEL_CHUNK_SIZE, start, end)
+
+        if n_workers > 1:
+            tasks = ((src_path, byte_start, byte_end, engine) for byte_start, byte_end in ranges)
+            results = map_parallel(_parse_range, tasks, n_workers)
+        else:
+            results = (_parse_range(src_path, byte_start, byte_end, engine) for byte_start, byte_end in ranges)
+
+        return self._reindex(results)
+
+    def _iter_batches_stream(self, src_path, n_workers, engine):
+        """
+        Streaming mode of iter_batches (compressed files): pieces of the decompressed file are parsed (in a process pool
+        if n_workers > 1) while the next ones are being decompressed. Yields (review_df, quarantine) pairs.
+        """
+
+        chunks = iter_record_chunks(src_path, PARALLEL_CHUNK_SIZE)
+
+        if n_workers > 1:
+            results = map_parallel(_parse_chunk, ((content, engine) for content in chunks), n_workers)
+        else:
+            results = (_parse_chunk(content, engine) for content in chunks)
+
+        return self._reindex(results)
+
+    def _reindex(self, results):
+        """
+        Gives the DFs of consecutive pieces of the file a global index. Yields (review_df, quarantine) pairs.
+        """
+
+        index = 0
+        for review_df, quarantine in results:
+            review_df.index = pd.RangeIndex(index, index + len(review_df))
+            index += len(review_df)
+            yield review_df, quarantine
+
+    def _to_dataframe(self, dictionary, start=0):
+        """
+        Turns the parsed dictionary into a pandas DF and adds the readable date.
+
+        Args:
+            dictionary (dict): Parsed reviews, as returned by _parse_rows.
+            start (int): Index of the first review (so that batches keep a global index).
+
+        Return:
+            review_df (pd.DataFrame): DF with the reviews.
+        """
 
-        # parse reviews
-        dictionary = self._parse_reviews(content)
         review_df = pd.DataFrame(dictionary)
+        review_df.index = pd.RangeIndex(start, start + len(review_df))
 
         # date of the review is in unix time, we have to convert it
-        column_date = pd.to_datetime(review_df['date'], unit='s').dt.date
+        column_date = pd.to_datetime(review_df['date'].astype('int64'), unit='s').dt.date
         review_df['readable_date'] = column_date
 
-        # save to csv (file is around 1.7GB)
-        review_df.to_csv(dst_path)
+        return review_df
+
+    def _to_typed(self, review_df):
+        """
+        Converts the parsed (string) columns to the types of REVIEWS_SCHEMA.
+
+        Args:
+            review_df (pd.DataFrame): DF with the reviews, as returned by _to_dataframe.
+
+        Return:
+            table (pa.Table): Typed table of the reviews.
+        """
+
+        typed_df = review_df.copy()
+        for field in REVIEWS_SCHEMA:
+            if pa.types.is_floating(field.type):
+                typed_df[field.name] = pd.to_numeric(review_df[field.name], errors='coerce').astype('float32')
+            elif pa.types.is_integer(field.type):
+                typed_df[field.name] = review_df[field.name].astype(field.type.to_pandas_dtype())
+
+        return pa.Table.from_pandas(typed_df, schema=REVIEWS_SCHEMA, preserve_index=False)
+
+    def _load_checkpoint(self, src_path, dst_path):
+        """
+        Loads the checkpoint of dst_path, if it is still valid for src_path: the output exists and the part of the
+        reviews file that was parsed is unchanged (same hash), i.e. reviews were only appended since.
+
+        Return:
+            checkpoint (dict): Keys offset, prefix_hash and n_reviews, or None if there is no valid checkpoint.
+        """
+
+        checkpoint_path = pathlib.Path(str(dst_path) + CHECKPOINT_SUFFIX)
+        if not checkpoint_path.exists() or not pathlib.Path(dst_path).exists():
+            return None
+
+        with open(checkpoint_path) as file:
+            checkpoint = json.load(file)
+
+        if checkpoint['offset'] > os.path.getsize(src_path):
+            return None
+        if file_prefix_hashes(src_path, [checkpoint['offset']])[0] != checkpoint['prefix_hash']:
+            return None
+
+        return checkpoint
+
+    def _save_checkpoint(self, src_path, dst_path, offset, n_reviews):
+        """
+        Saves the checkpoint of dst_path: byte offset reached in src_path, hash of the parsed prefix and number of reviews.
+        """
+
+        checkpoint = {'src_path': str(src_path),
+                      'offset': offset,
+                      'prefix_hash': file_prefix_hashes(src_path, [offset])[0],
+                      'n_reviews': n_reviews}
+
+        checkpoint_path = pathlib.Path(str(dst_path) + CHECKPOINT_SUFFIX)
+        tmp_path = checkpoint_path.with_name(checkpoint_path.name + '.tmp')
+        with open(tmp_path, 'w') as file:
+            json.dump(checkpoint, file)
+        os.replace(tmp_path, checkpoint_path)
+
+    def _append_parquet_part(self, dst_path, batches):
+        """
+        Writes new reviews as the next part file of the .parquet dataset directory dst_path (a single .parquet file is first
+        renamed to the first part of the directory). The part is written to a hidden temporary file first, which readers
+        ignore, so a crash never leaves a truncated part.
+
+        Args:
+            dst_path (pathlib.Path): .parquet file or dataset directory with the reviews parsed before.
+            batches (iterable): DFs of the new reviews.
+
+        Return:
+            n_reviews (int): Number of new reviews.
+        """
+
+        dst_path = pathlib.Path(dst_path)
+        if dst_path.is_file():
+            tmp_path = pathlib.Path(str(dst_path) + '.tmp')
+            os.replace(dst_path, tmp_path)
+            dst_path.mkdir()
+            os.replace(tmp_path, dst_path / 'part-00000.parquet')
+
+        part_path = dst_path / f"part-{len(parquet_files(dst_path)):05d}.parquet"
+        tmp_path = dst_path / f".{part_path.name}.tmp"
+
+        n_reviews = 0
+        with pq.ParquetWriter(tmp_path, REVIEWS_SCHEMA, compression='zstd') as writer:
+            for review_df in batches:
+                n_reviews += len(review_df)
+                writer.write_table(self._to_typed(review_df))
+
+        # Nothing was appended to the reviews file, no empty part
+        if n_reviews:
+            os.replace(tmp_path, part_path)
+        else:
+            tmp_path.unlink()
+
+        return n_reviews
+
+    def generate_result(self, src_path, dst_path, batch_size=100_000, n_workers=1, engine='python', quarantine_path=None,
+                        incremental=False):
+        """
+        Generate the result of parsing the reviews into a pandas DF and save it as a .csv file.
+        If dst_path ends with .parquet, the reviews are saved as typed, compressed columns instead (see REVIEWS_SCHEMA).
+        The file is streamed and written in batches, so peak memory depends on batch_size and not on the size of the file.
+        A checkpoint (byte offset reached and hash of the parsed part of src_path) is saved next to dst_path.
+        With incremental=True and a valid checkpoint, only the reviews appended to src_path since the checkpoint are parsed,
+        and appended to dst_path. A .parquet output then becomes a dataset directory (the reviews parsed before are renamed to
+        its first part file) and the new reviews are written as one more part file, without reading the previous ones;
+        load_reviews and iter_review_chunks read all the parts in order.
+        Reviews are expected to be appended whole: a review still being written when the parse runs would be cut.
+        src_path can also be compressed (reviews.txt.gz, reviews.txt.bz2 or BeerAdvocate.tar.gz, see open_reviews):
+        it is then decompressed and parsed in a pipeline, without extracting it to disk (and without checkpoint).
+        @param src_path: path of the file with reviews to parse
+        @param dst_path: path where to save the .csv (or .parquet) file with the parsed reviews
+        @param batch_size: number of reviews parsed and written at once
+        @param n_workers: number of processes parsing the file in parallel (1 parses in the current process),
+        capped so that they fit in half of the memory (see parallel_workers)
+        @param engine: 'python' (line by line) or 'numpy' (vectorized over the memory-mapped file)
+        @param quarantine_path: path where to save the malformed reviews (they are dropped if None)
+        @param incremental: parse only what was appended to src_path since the last checkpoint of dst_path
+        """
+
+        self.n_quarantined = 0
+
+        # Byte offsets only make sense in a plain file
+        compressed = is_compressed(src_path)
+
+        checkpoint = self._load_checkpoint(src_path, dst_path) if incremental and not compressed else None
+        start = checkpoint['offset'] if checkpoint is not None else 0
+        n_reviews = checkpoint['n_reviews'] if checkpoint is not None else 0
+        end = os.path.getsize(src_path) if not compressed else None
+
+        batches = self.iter_batches(src_path, batch_size, n_workers, engine, quarantine_path, start, end)
+
+        with INSTRUMENTATION.stage('parse') as stage:
+            stage.n_workers = parallel_workers(n_workers)
+            if pathlib.Path(dst_path).suffix == '.parquet' and checkpoint is not None:
+                n_reviews += self._append_parquet_part(dst_path, batches)
+            elif pathlib.Path(dst_path).suffix == '.parquet':
+                tmp_path = pathlib.Path(str(dst_path) + '.tmp')
+                with pq.ParquetWriter(tmp_path, REVIEWS_SCHEMA, compression='zstd') as writer:
+                    for review_df in batches:
+                        n_reviews += len(review_df)
+                        writer.write_table(self._to_typed(review_df))
+                # A full parse replaces the dataset directory of previous incremental parses
+                if pathlib.Path(dst_path).is_dir():
+                    shutil.rmtree(dst_path)
+                os.replace(tmp_path, dst_path)
+            else:
+                header = checkpoint is None
+                first_index = n_reviews
+                for review_df in batches:
+                    # save to csv (file is around 1.7GB), appending batch after batch
+                    review_df.index = review_df.index + first_index
+                    review_df.to_csv(dst_path, mode='w' if header else 'a', header=header)
+                    n_reviews += len(review_df)
+                    header = False
+
+                # Empty input still gives a file with the columns
+                if header:
+                    self._to_dataframe(self._parse_rows([])).to_csv(dst_path)
+
+            stage.rows = n_reviews - (checkpoint['n_reviews'] if checkpoint is not None else 0)
+
+        if not compressed:
+            self._save_checkpoint(src_path, dst_path, end, n_reviews)
+
+        if self.n_quarantined:
+            print(f"{self.n_quarantined} malformed reviews were skipped.")
 
 
 if __name__ == '__main__':
     parser = BeerAdvocateParser()
     data_dir_path = pathlib.Path("../../data")
 
-    src_path = '/Users/david/BeerAdvocate/reviews.txt' # data_dir_path / "reviews.txt"
-    dst_path = data_dir_path / 'generated' / "reviews_df.csv"
+    # reviews.txt, or the archive it ships in (e.g. BeerAdvocate.tar.gz), can be given on the command line
+    src_path = pathlib.Path(sys.argv[1]) if len(sys.argv) > 1 else data_dir_path / "BeerAdvocate" / "reviews.txt"
+    dst_path = data_dir_path / 'generated' / "reviews_df.parquet"
 
-    parser.generate_result(src_path, dst_path)
+    parser.generate_result(src_path, dst_path, n_workers=os.cpu_count(), engine='numpy', incremental=True)
@@ -0,0 +1,330 @@
+import os
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+from src.data.reviews_sketch import estimate_distinct, hash_users, sketch_registers
+
+# Keys of the cells of the cube
+CUBE_KEYS = ['state', 'year', 'general_style', 'sentiment_label']
+
+# Additive measures of each cell: any aggregation of reviews over the keys can be computed from their sums
+CUBE_MEASURES = ['n_reviews', 'rating_count', 'rating_sum', 'rating_sumsq']
+
+# States with reviews in all the years
+OVERLAPPING_STATES = ['New York', 'California', 'New Hampshire', 'Wisconsin', 'Nevada', 'Pennsylvania', 'Virginia', 'Ohio',
+                      'Florida', 'North Carolina', 'Arizona', 'Indiana', 'Georgia', 'Texas', 'South Carolina', 'Iowa',
+                      'Kentucky']
+
+
+class ReviewsCube:
+    """
+    Materialized aggregate of the US reviews: for each state, year, general style and sentiment label, the number of reviews
+    and the count, sum and sum of squares of their ratings, and a sketch of their distinct users (see reviews_sketch).
+    It is built in one pass over the reviews, and then answers the average ratings, sentiment fractions, review counts
+    and approximate numbers of distinct users without touching the reviews again.
+    """
+
+    def __init__(self, cells, sketches):
+        """
+        Initializes the cube from its cells (use from_reviews or load to build one).
+
+        Args:
+            @cells (pd.DataFrame): Index CUBE_KEYS (sentiment_label is NaN for reviews without sentiment), columns CUBE_MEASURES.
+            @sketches (pd.DataFrame): Same index as cells, one uint8 column per register of the sketch of the users of the cell.
+        """
+        self.cells = cells
+        self.sketches = sketches
+
+    @classmethod
+    def from_reviews(cls, reviews_df):
+        """
+        Aggregates reviews into a cube, with one grouped sum.
+
+        Args:
+            @reviews_df (pd.DataFrame): US reviews with general style, e.g. from Reviews.filter_beer_type (user_id, state, year, general_style, rating and optionally sentiment_label columns).
+
+        Returns:
+            @cube (ReviewsCube): Cube of the reviews.
+        """
+
+        if 'sentiment_label' in reviews_df.columns:
+            labels = reviews_df['sentiment_label']
+        else:
+            labels = pd.Series(np.nan, index=reviews_df.index, dtype=object, name='sentiment_label')
+        keys = [reviews_df['state'], reviews_df['year'], reviews_df['general_style'], labels]
+
+        rating = reviews_df['rating'].astype('float64')
+        measures = pd.DataFrame({'n_reviews': np.ones(len(reviews_df), dtype=np.int64),
+                                 'rating_count': rating.notna().astype(np.int64),
+                                 'rating_sum': rating.fillna(0),
+                                 'rating_sumsq': rating.fillna(0) ** 2}, index=reviews_df.index)
+
+        grouped = measures.groupby(keys, observed=True, dropna=False)
+        cells = grouped.sum()
+
+        # Groups are numbered in the order of the cells
+        registers = sketch_registers(hash_users(reviews_df['user_id']), grouped.ngroup().to_numpy(), len(cells))
+        sketches = pd.DataFrame(registers, index=cells.index.copy())
+
+        return cls(_plain_index(cells), _plain_index(sketches))
+
+    @classmethod
+    def combine(cls, cubes):
+        """
+        Combines cubes of disjoint sets of reviews (e.g. chunks of the reviews) into the cube of all of them.
+        Each cube is folded into the running cube as it arrives (see add), so only the running cube and one partial cube
+        are in memory at once, whatever the number of cubes.
+        
+        Args:
+            @cubes (iterable): Partial cubes.
+            
+        Returns:
+            @cube (ReviewsCube): Cube of all the reviews.
+        """
+        
+        combined = None
+        for cube in cubes:
+            if combined is None:
+                combined = cube.copy()
+            else:
+                combined.add(cube)
+        
+        if combined is None:
+            return cls.from_reviews(pd.DataFrame({key: [] for key in ['user_id', 'state', 'year', 'general_style', 'rating']}))
+        
+        return combined
+
+    def add(self, delta):
+        """
+        Folds the cube of new reviews into this cube, in place. The cells that already exist are updated in time
+        proportional to the size of delta, only new cells (e.g. of a new year) make the whole cube reindex.
+
+        Args:
+            @delta (ReviewsCube): Cube of reviews that are not in this cube yet.
+        """
+
+        positions = self.cells.index.get_indexer(delta.cells.index)
+        found = positions >= 0
+
+        for column in CUBE_MEASURES:
+            column_position = self.cells.columns.get_loc(column)
+            self.cells.iloc[positions[found], column_position] += delta.cells[column].to_numpy()[found]
+        self.sketches.iloc[positions[found]] = np.maximum(self.sketches.iloc[positions[found]].to_numpy(),
+                                                          delta.sketches.to_numpy()[found])
+
+        if not found.all():
+            self.cells = _plain_index(pd.concat([self.cells, delta.cells[~found]]))
+            self.sketches = _plain_index(pd.concat([self.sketches, delta.sketches[~found]]))
+
+    def copy(self):
+        """
+        Copy of the cube, that can be updated (see add) without changing this one.
+        """
+        return ReviewsCube(self.cells.copy(), self.sketches.copy())
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by the cells and the sketches of the cube.
+        """
+        return int(self.cells.memory_usage(deep=True).sum() + self.sketches.memory_usage(deep=True).sum())
+
+    def save(self, path, source=None):
+        """
+        Saves the cube (cells and sketches) as a pickle file (written to a temporary file first, so a crash never leaves
+        a truncated cube).
+
+        Args:
+            @path (pathlib.Path): Where to save the cube.
+            @source: Identity of the files the cube was built from (e.g. their file_identity), checked by load.
+        """
+        tmp_path = pathlib.Path(str(path) + '.tmp')
+        pd.to_pickle({'cells': self.cells, 'sketches': self.sketches, 'source': source}, tmp_path)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, source=None):
+        """
+        Loads a cube saved with save.
+
+        Args:
+            @path (pathlib.Path): Path of the saved cube.
+            @source: If given, identity of the files the cube must have been built from.
+
+        Returns:
+            @cube (ReviewsCube): The cube, None if it was saved for another source (e.g. the reviews changed since).
+        """
+        saved = pd.read_pickle(path)
+        if source is not None and saved.get('source') != source:
+            return None
+        return cls(saved['cells'], saved['sketches'])
+
+    def aggregate(self, by, states=None, years=None, users=False):
+        """
+        Aggregates the cells over the keys that are not in by.
+
+        Args:
+            @by (list): Keys to keep, e.g. ['state', 'year', 'general_style'].
+            @states (list): States to keep, all of them if None.
+            @years (list): Years to keep, all of them if None.
+            @users (bool): Whether to merge the sketches into the number of distinct users (which takes most of the time of a query).
+
+        Returns:
+            @aggregated (pd.DataFrame): One row per combination of the by keys (sorted), with columns n_reviews, n_positive, n_negative, avg_rating, rating_std (sample standard deviation) and, if users, n_users (approximate number of distinct users).
+        """
+
+        keep = np.ones(len(self.cells), dtype=bool)
+        if states is not None:
+            keep &= self.cells.index.get_level_values('state').isin(states)
+        if years is not None:
+            keep &= self.cells.index.get_level_values('year').isin(years)
+
+        return _summarize(self.cells[keep], self.sketches[keep] if users else None, by)
+
+    def lookup(self, keys):
+        """
+        Aggregates the cells of some states, years and general styles over the sentiment labels, like aggregate does,
+        in time proportional to the number of keys (e.g. the keys of the cells changed by add).
+
+        Args:
+            @keys (pd.MultiIndex): Levels state, year and general_style.
+
+        Returns:
+            @aggregated (pd.DataFrame): Same columns as aggregate(['state', 'year', 'general_style'], users=True), for the keys that have cells.
+        """
+
+        # Cells of the keys, for each sentiment label of the cube and the missing one
+        labels = list(self.cells.index.levels[CUBE_KEYS.index('sentiment_label')]) + [np.nan]
+        key_arrays = [keys.get_level_values(key) for key in CUBE_KEYS[:-1]]
+        positions = np.concatenate([self.cells.index.get_indexer(pd.MultiIndex.from_arrays(
+                                        key_arrays + [np.full(len(keys), label, dtype=object)], names=CUBE_KEYS))
+                                    for label in labels])
+
+        # In the order of the cube, so that the sums are the same as in aggregate
+        positions = np.sort(positions[positions >= 0])
+
+        return _summarize(self.cells.iloc[positions], self.sketches.iloc[positions], ['state', 'year', 'general_style'])
+
+    def average_ratings(self, years, states=None):
+        """
+        Average rating per state, year and general style, in wide format (see Reviews.aggregate_preferences_year).
+
+        Args:
+            @years (list): Years of the columns, in order.
+            @states (list): States to keep, all of them if None.
+
+        Returns:
+            @wide_df (pd.DataFrame): Each row represents one state and columns are e.g. IPA_2004, Lager_2004, ..., IPA_2005, ...
+        """
+
+        long_df = self.aggregate(['state', 'year', 'general_style'], states=states)
+
+        return to_wide(long_df, 'avg_rating', years)
+
+    def sentiment_fractions(self, states=None):
+        """
+        Fractions of positive and negative reviews per state, year and general style (see Reviews.posneg_sentiment_aggregation_counts).
+
+        Args:
+            @states (list): States to keep, all of them if None.
+
+        Returns:
+            @fractions (pd.DataFrame): Columns [state, year, general_style, NEGATIVE, POSITIVE], for the combinations with labelled reviews.
+        """
+
+        long_df = self.aggregate(['state', 'year', 'general_style'], states=states)
+        long_df = long_df[long_df['n_positive'] + long_df['n_negative'] > 0].reset_index(drop=True)
+
+        long_df['NEGATIVE'] = long_df['n_negative'] / (long_df['n_negative'] + long_df['n_positive'])
+        long_df['POSITIVE'] = 1 - long_df['NEGATIVE']
+
+        fractions = long_df[['state', 'year', 'general_style', 'NEGATIVE', 'POSITIVE']]
+        fractions.columns.name = 'sentiment_label'
+
+        return fractions
+
+    def review_counts(self, years=None):
+        """
+        Number of reviews per general style and year (see plotting_utils.plot_review_count).
+
+        Args:
+            @years (list): Years to keep, all of them if None.
+
+        Returns:
+            @counts (pd.DataFrame): Columns [general_style, year, count].
+        """
+
+        counts = self.aggregate(['general_style', 'year'], years=years)
+
+        return counts[['general_style', 'year', 'n_reviews']].rename(columns={'n_reviews': 'count'})
+
+
+def to_wide(long_df, values, years, period='year'):
+    """
+    Converts aggregated values (one row per state, period and general style) into wide format in a single reshape.
+
+    Args:
+        @long_df (pd.DataFrame): Contains columns state, general_style, period and values (one row per combination).
+        @values (str): Column with the aggregated values.
+        @years (list): Periods to keep, in the order of the columns (e.g. years, or any other period in the period column).
+        @period (str): Column with the periods.
+
+    Returns:
+        @wide_df (pd.DataFrame): Each row represents one state (sorted) and columns are e.g. IPA_2004, Lager_2004, ..., IPA_2005, ... i.e. for each period, one column per general style that has values in that period.
+    """
+
+    years = list(years)
+    long_df = long_df[long_df[period].isin(years)]
+
+    # States and styles as plain strings, so that only the combinations that exist become rows and columns
+    keys = [long_df['state'].astype(str), long_df[period], long_df['general_style'].astype(str)]
+    wide_df = long_df[values].set_axis(pd.MultiIndex.from_arrays(keys, names=['state', period, 'general_style'])).unstack([period, 'general_style'])
+
+    # Like a pivot table: no row or column without values
+    wide_df = wide_df.dropna(axis=0, how='all').dropna(axis=1, how='all')
+
+    # Periods in the given order, styles in alphabetical order
+    position = {year: index for index, year in enumerate(years)}
+    wide_df = wide_df[sorted(wide_df.columns, key=lambda column: (position[column[0]], column[1]))]
+    wide_df.columns = [f"{style}_{year}" for year, style in wide_df.columns]
+
+    return wide_df.sort_index()
+
+
+def _plain_index(cells):
+    """
+    Turns the (categorical) keys of the cells into plain values and sorts them, so that cubes built separately can be combined.
+    """
+
+    keys = [cells.index.get_level_values(key).astype(np.int64 if key == 'year' else object) for key in CUBE_KEYS]
+    cells.index = pd.MultiIndex.from_arrays(keys, names=CUBE_KEYS)
+
+    return cells.sort_index()
+
+
+def _summarize(cells, sketches, by):
+    """
+    Sums cells over the keys that are not in by, and adds the average and standard deviation of the ratings,
+    and the number of distinct users from the merged sketches if they are given (see ReviewsCube.aggregate).
+    """
+
+    labels = cells.index.get_level_values('sentiment_label')
+    cells = cells.assign(n_positive=cells['n_reviews'].where(labels == 'POSITIVE', 0),
+                         n_negative=cells['n_reviews'].where(labels == 'NEGATIVE', 0))
+
+    totals = cells.groupby(level=by, dropna=False).sum()
+
+    count = totals['rating_count']
+    totals['avg_rating'] = (totals['rating_sum'] / count).where(count > 0)
+    variance = (totals['rating_sumsq'] - totals['rating_sum'] ** 2 / count) / (count - 1)
+    totals['rating_std'] = np.sqrt(variance.clip(lower=0)).where(count > 1)
+
+    columns = ['n_reviews', 'n_positive', 'n_negative', 'avg_rating', 'rating_std']
+    if sketches is not None:
+        merged = sketches.groupby(level=by, dropna=False).max()
+        totals['n_users'] = pd.Series(estimate_distinct(merged.to_numpy()), index=merged.index)
+        columns.insert(4, 'n_users')
+
+    return totals[columns].reset_index()
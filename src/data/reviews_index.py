@@ -0,0 +1,351 @@
+import mmap
+import os
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+from src.data.load_and_parse_beeradvocate_reviews import (FIELD_BY_NAME, FIELD_POSITIONS, FIELDS, INTEGER_FIELDS,
+                                                           REQUIRED_FIELDS, file_prefix_hashes, is_compressed,
+                                                           record_aligned_ranges)
+
+# Fields whose value is read from reviews.txt: the keys of a review, and the fields the parser requires to keep a review
+VALUE_FIELDS = ['beer_id', 'user_id', 'date'] + [field for field in REQUIRED_FIELDS if field not in ('beer_id', 'user_id', 'date')]
+
+# Bytes of the name of each field, zero padded (one row per field in FIELDS)
+FIELD_NAME_BYTES = np.frombuffer(b''.join(field.encode().ljust(len(FIELD_BY_NAME), b'\0') for field in FIELDS),
+                                 dtype=np.uint8).reshape(len(FIELDS), -1)
+
+
+class ReviewsIndex:
+    """
+    Side index of reviews.txt: byte offsets of every review, by parsed row number (row of the review in the parsed reviews,
+    i.e. among the reviews the parser keeps) and by (beer_id, user_id, date), to read single reviews without loading
+    the parsed reviews. Malformed reviews, which the parser quarantines, are indexed but have no row number.
+    The index is built by its own pass over reviews.txt (separate from the parse), and only the reviews appended to the
+    file since it was indexed are indexed again (see extend).
+    """
+
+    def __init__(self, src_path, starts, ends, beer_ids, user_codes, user_ids, dates, parsed_rows, file_size,
+                 file_mtime_ns, prefix_hash):
+        """
+        Use ReviewsIndex.build or ReviewsIndex.load instead.
+
+        Args:
+            src_path (pathlib.Path): Path of the indexed reviews file.
+            starts (np.ndarray): Byte offset of the first character of each review.
+            ends (np.ndarray): Byte offset just after the last character of each review.
+            beer_ids (np.ndarray): beer_id of each review (-1 if missing).
+            user_codes (np.ndarray): Position of the user_id of each review in user_ids (-1 if missing).
+            user_ids (np.ndarray): Sorted unique user ids.
+            dates (np.ndarray): date (unix time) of each review (-1 if missing).
+            parsed_rows (np.ndarray): Row of each review in the parsed reviews (-1 if the parser quarantines it).
+            file_size (int): Size of the reviews file when it was indexed.
+            file_mtime_ns (int): Modification time of the reviews file when it was indexed.
+            prefix_hash (str): Hash of the indexed bytes of the file (see file_prefix_hashes).
+        """
+
+        self.src_path = src_path
+        self.starts = starts
+        self.ends = ends
+        self.beer_ids = beer_ids
+        self.user_codes = user_codes
+        self.user_ids = user_ids
+        self.dates = dates
+        self.parsed_rows = parsed_rows
+        self.file_size = file_size
+        self.file_mtime_ns = file_mtime_ns
+        self.prefix_hash = prefix_hash
+
+        self._sort_keys()
+
+    def __len__(self):
+        return len(self._positions)
+
+    def _sort_keys(self):
+        """
+        Computes the lookup tables of the index from its arrays.
+        """
+
+        # Position in the file of each parsed row
+        self._positions = np.flatnonzero(self.parsed_rows >= 0)
+
+        # Parsed reviews sorted on (user, beer, date), so that a key lookup is a binary search
+        self._by_key = self._positions[np.lexsort((self.dates[self._positions], self.beer_ids[self._positions],
+                                                   self.user_codes[self._positions]))]
+        self._key_users = self.user_codes[self._by_key]
+        self._key_beers = self.beer_ids[self._by_key]
+        self._key_dates = self.dates[self._by_key]
+        self._user_positions = {user_id: code for code, user_id in enumerate(self.user_ids.tolist())}
+
+    @classmethod
+    def build(cls, src_path):
+        """
+        Indexes a reviews file in one pass over the memory-mapped file, one record aligned range at a time.
+
+        Args:
+            src_path (pathlib.Path): Path of the file with reviews.
+
+        Return:
+            index (ReviewsIndex): The index of the file.
+        """
+
+        # Offsets are only meaningful (and seekable) in the plain file
+        if is_compressed(src_path):
+            raise ValueError(f"{src_path} is compressed, extract reviews.txt to index it.")
+
+        empty = np.empty(0, dtype=np.int64)
+        index = cls(src_path, empty, empty, empty, np.empty(0, dtype=np.int32), np.empty(0, dtype=str), empty, empty,
+                    0, None, file_prefix_hashes(src_path, [0])[0])
+        index.extend()
+
+        return index
+
+    def extend(self):
+        """
+        Indexes the reviews appended to the file since it was indexed, if any (e.g. before parsing them with
+        generate_result(..., incremental=True)): only the new bytes are read, besides the hash of the indexed ones.
+
+        Return:
+            extended (bool): True if the file changed since it was indexed.
+
+        Raises:
+            ValueError: If the indexed part of the file changed (the index has to be built again).
+        """
+
+        status = os.stat(self.src_path)
+        if (status.st_size, status.st_mtime_ns) == (self.file_size, self.file_mtime_ns):
+            return False
+
+        if status.st_size < self.file_size or file_prefix_hashes(self.src_path, [self.file_size])[0] != self.prefix_hash:
+            raise ValueError(f"{self.src_path} changed since it was indexed, build the index again.")
+
+        pieces = []
+        if status.st_size > self.file_size:
+            with open(self.src_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                for start, end in record_aligned_ranges(self.src_path, start=self.file_size, end=status.st_size):
+                    pieces.append(_index_range(buffer[start:end], start))
+
+        if pieces:
+            starts, ends, beer_ids, users, dates, kept = (np.concatenate(arrays) for arrays in zip(*pieces))
+
+            # Rows of the parsed reviews are numbered in the order of the file, without the quarantined reviews
+            n_parsed = int(np.count_nonzero(self.parsed_rows >= 0))
+            parsed_rows = np.where(kept, n_parsed + np.cumsum(kept) - 1, -1)
+
+            # Users are stored once, reviews refer to them by position (in the users of the old and the new reviews)
+            missing = pd.isna(users)
+            user_ids = np.array(sorted(set(self.user_ids.tolist()) | set(users[~missing].tolist())), dtype=str)
+            old_codes = np.searchsorted(user_ids, self.user_ids).astype(np.int32)
+            user_codes = np.full(len(users), -1, dtype=np.int32)
+            user_codes[~missing] = np.searchsorted(user_ids, users[~missing].astype(str))
+
+            self.starts = np.concatenate([self.starts, starts])
+            self.ends = np.concatenate([self.ends, ends])
+            self.beer_ids = np.concatenate([self.beer_ids, beer_ids])
+            self.user_codes = np.concatenate([np.where(self.user_codes >= 0, old_codes[self.user_codes], -1), user_codes])
+            self.user_ids = user_ids
+            self.dates = np.concatenate([self.dates, dates])
+            self.parsed_rows = np.concatenate([self.parsed_rows, parsed_rows])
+            self._sort_keys()
+
+        self.file_size, self.file_mtime_ns = status.st_size, status.st_mtime_ns
+        self.prefix_hash = file_prefix_hashes(self.src_path, [self.file_size])[0]
+
+        return True
+
+    def save(self, index_path):
+        """
+        Saves the index as a (compressed) .npz file.
+
+        Args:
+            index_path (pathlib.Path): Where to save the index.
+        """
+
+        with open(index_path, 'wb') as file:
+            np.savez_compressed(file, starts=self.starts, ends=self.ends, beer_ids=self.beer_ids,
+                                user_codes=self.user_codes, user_ids=self.user_ids, dates=self.dates,
+                                parsed_rows=self.parsed_rows, file_size=np.int64(self.file_size),
+                                file_mtime_ns=np.int64(self.file_mtime_ns), prefix_hash=np.str_(self.prefix_hash))
+
+    @classmethod
+    def load(cls, index_path, src_path):
+        """
+        Loads an index saved with save, for the reviews file it was built from, and extends it with the reviews appended
+        to the file since then (see extend, save it again to keep them).
+
+        Args:
+            index_path (pathlib.Path): Path of the saved index.
+            src_path (pathlib.Path): Path of the indexed reviews file.
+
+        Return:
+            index (ReviewsIndex): The index of the file.
+
+        Raises:
+            ValueError: If the index is from an older version, or the indexed part of the file changed.
+        """
+
+        with np.load(index_path) as arrays:
+            if 'parsed_rows' not in arrays or 'prefix_hash' not in arrays:
+                raise ValueError(f"{index_path} is from an older version of the index, build the index again.")
+            index = cls(src_path, arrays['starts'], arrays['ends'], arrays['beer_ids'], arrays['user_codes'],
+                        arrays['user_ids'], arrays['dates'], arrays['parsed_rows'], int(arrays['file_size']),
+                        int(arrays['file_mtime_ns']), str(arrays['prefix_hash']))
+
+        index.extend()
+
+        return index
+
+    def find(self, beer_id, user_id, date):
+        """
+        Finds the parsed row number of a review from its key, with binary searches on the sorted keys.
+
+        Args:
+            beer_id (int): Id of the beer.
+            user_id (str): Id of the user.
+            date (int): Date of the review (unix time).
+
+        Return:
+            review_number (int): Row of the review in the parsed reviews, None if there is no such review (or the parser
+                quarantines it).
+        """
+
+        code = self._user_positions.get(user_id)
+        if code is None:
+            return None
+
+        low, high = np.searchsorted(self._key_users, [code, code + 1])
+        low, high = low + np.searchsorted(self._key_beers[low:high], [beer_id, beer_id + 1])
+        low, high = low + np.searchsorted(self._key_dates[low:high], [date, date + 1])
+
+        return int(self.parsed_rows[self._by_key[low]]) if low < high else None
+
+    def read(self, review_number):
+        """
+        Reads the raw text of one review, seeking directly to its offset.
+
+        Args:
+            review_number (int): Row of the review in the parsed reviews.
+
+        Return:
+            review (str): The lines of the review, as in reviews.txt.
+        """
+
+        position = self._positions[review_number]
+        start, end = int(self.starts[position]), int(self.ends[position])
+        with open(self.src_path, 'rb') as file:
+            file.seek(start)
+            return file.read(end - start).decode('utf-8')
+
+    def get(self, review_number):
+        """
+        Reads one review and splits it into fields (like the parser does).
+
+        Args:
+            review_number (int): Row of the review in the parsed reviews.
+
+        Return:
+            review (dict): Field name -> value, for the fields in FIELDS that the review has.
+        """
+
+        review = {}
+        for line in self.read(review_number).split('\n'):
+            field = line.split(':', 1)[0]
+            if field in FIELDS and field not in review:
+                review[field] = line.split(': ')[1] if ': ' in line else ''
+
+        return review
+
+    def lookup(self, beer_id, user_id, date):
+        """
+        Reads one review from its key, see find and get.
+
+        Return:
+            review (dict): Field name -> value, None if there is no such review.
+        """
+
+        review_number = self.find(beer_id, user_id, date)
+
+        return self.get(review_number) if review_number is not None else None
+
+
+def _index_range(buffer, offset):
+    """
+    Indexes the reviews of a record aligned piece of the reviews file.
+
+    Args:
+        buffer (bytes): The piece of the file.
+        offset (int): Byte offset of the piece in the file.
+
+    Return:
+        arrays (tuple): starts, ends, beer_ids, user_ids and dates of the reviews in the piece, and whether the parser keeps them.
+    """
+
+    content = np.frombuffer(buffer, dtype=np.uint8)
+    newline = content == ord('\n')
+
+    # A review starts on a non empty line that follows an empty line (or the start of the piece),
+    # and ends where the next separator (or the piece) starts
+    after_newline = np.concatenate([[True], newline[:-1]])
+    after_blank_line = np.concatenate([[True, True], newline[:-2]])[:len(content)]
+    starts = np.flatnonzero(~newline & after_newline & after_blank_line)
+    separators = np.flatnonzero(newline[:-1] & newline[1:])
+    ends = np.append(separators, len(content))[np.searchsorted(separators, starts)]
+
+    # The last review of the file may end with a single newline
+    if len(ends) and ends[-1] == len(content) and content[-1] == ord('\n'):
+        ends[-1] -= 1
+
+    # Field of each line: the name before the first ':' (guessed from its length and first byte, then checked)
+    line_starts = np.flatnonzero(np.concatenate([[True], newline[:-1]]))
+    line_ends = np.append(np.flatnonzero(newline), len(content))[np.searchsorted(np.flatnonzero(newline), line_starts)]
+    colons = np.append(np.flatnonzero(content == ord(':')), len(content))
+    name_lengths = colons[np.searchsorted(colons, line_starts)] - line_starts
+    named = np.flatnonzero((line_starts + name_lengths < line_ends) & (name_lengths < len(FIELD_BY_NAME)))
+    fields = FIELD_BY_NAME[name_lengths[named], content[line_starts[named]]]
+    named, fields = named[fields >= 0], fields[fields >= 0]
+    padded = np.concatenate([content, np.zeros(len(FIELD_BY_NAME), dtype=np.uint8)])
+    for position in range(1, len(FIELD_BY_NAME)):
+        same = (padded[line_starts[named] + position] == FIELD_NAME_BYTES[fields, position]) | (position >= name_lengths[named])
+        named, fields = named[same], fields[same]
+    reviews = np.searchsorted(starts, line_starts[named], side='right') - 1
+
+    # Like the parser, a review is kept if none of its fields is repeated and its required fields are set
+    # (integers for the ids and the date)
+    counts = np.zeros((len(starts), len(FIELDS)), dtype=np.int64)
+    np.add.at(counts, (reviews, fields), 1)
+    kept = np.all(counts <= 1, axis=1)
+
+    keys = {}
+    for field in VALUE_FIELDS:
+        # Like the parser, only the first occurrence of a field in a review counts
+        field_reviews, first = np.unique(reviews[fields == FIELD_POSITIONS[field]], return_index=True)
+        lines = named[fields == FIELD_POSITIONS[field]][first]
+
+        # Value of the field as the parser reads it: what follows the first ': ' of the line, up to the next one
+        values = [line.split(b': ')[1] if b': ' in line else b''
+                  for line in (buffer[start:end] for start, end in zip(line_starts[lines].tolist(), line_ends[lines].tolist()))]
+        valid = np.zeros(len(starts), dtype=bool)
+        valid[field_reviews] = [value.isdigit() if field in INTEGER_FIELDS else bool(value) for value in values]
+        if field in REQUIRED_FIELDS:
+            kept &= valid
+
+        if field == 'user_id':
+            keys[field] = np.full(len(starts), None, dtype=object)
+            keys[field][field_reviews] = [value.decode('utf-8') for value in values]
+        elif field in ('beer_id', 'date'):
+            keys[field] = np.full(len(starts), -1, dtype=np.int64)
+            keys[field][field_reviews] = [int(value) if value.isdigit() else -1 for value in values]
+
+    return starts + offset, ends + offset, keys['beer_id'], keys['user_id'], keys['date'], kept
+
+
+if __name__ == '__main__':
+    data_dir_path = pathlib.Path("../../data")
+
+    src_path = data_dir_path / "reviews.txt"
+    index_path = data_dir_path / 'generated' / "reviews_index.npz"
+
+    # Only the reviews appended since the index was saved are indexed (the whole file the first time)
+    index = ReviewsIndex.load(index_path, src_path) if index_path.exists() else ReviewsIndex.build(src_path)
+    index.save(index_path)
@@ -1,134 +1,425 @@
+import functools
+import os
 import pathlib
 from sklearn.preprocessing import StandardScaler
+import numpy as np
 import pandas as pd
+from src.data.load_and_parse_beeradvocate_reviews import iter_review_chunks, load_reviews, map_parallel, reviews_columns
+from src.data.reviews_cube import OVERLAPPING_STATES, ReviewsCube, to_wide
+from src.data.reviews_schema import compact_dtypes, csv_dtypes
+from src.data.stage_cache import DEFAULT_CACHE, cache_copy, cached_stage, file_identity
+from src.utils.instrumentation import instrumented
+
+# General beer styles that are analyzed (in alphabetical order, like the columns of the aggregated DFs)
+GENERAL_STYLES = ['IPA', 'Lager', 'Other Ale', 'Pale Ale', 'Pilsner', 'Porter', 'Red/Amber Ale', 'Stout']
+
+# Columns of the reviews that the aggregations need, besides sentiment_label when the reviews have it
+# (so that the review text is never loaded for them)
+RATING_COLUMNS = ['user_id', 'date', 'style', 'rating']
+
+# Column with the position of each review in the reviews file, added to the cached reviews without text so that
+# the text can be joined back (see Reviews.make_age_state_cols)
+REVIEW_ROW = 'review_row'
+
+
+@functools.lru_cache(maxsize=None)
+def general_style(style):
+    """
+    Classifies a BeerAdvocate style into one of the general styles of interest.
+    Particularly: Pale Ale, Red/Amber Ale, IPA, Other Ales, Lager, Pilsener, Stout, Porter.
+    When several match, the more specific one wins (Pilsner, IPA, Porter, Stout, Red/Amber Ale, Lager, Other Ale, Pale Ale).
+    
+    Args:
+        @style (str): Style of the beer, e.g. 'American Double / Imperial IPA'.
+        
+    Returns:
+        @general_style (str): One of GENERAL_STYLES, None if the style is not analyzed.
+    """
+    
+    style_split = style.split(' ')
+    
+    pale_ale = 'Ale' in style_split and 'Pale' in style_split and 'India' not in style_split
+    ipa = 'IPA' in style_split or ('India' in style_split and 'Pale' in style_split and 'Ale' in style_split)
+    red_amber_ale = 'Ale' in style_split and ('Amber' in style_split or 'Red' in style_split)
+    
+    # IPA, Pale Ale and Red/Amber Ale are not in other Ales
+    other_ale = 'Ale' in style_split and not (ipa or pale_ale or red_amber_ale)
+    
+    matches = [('Pilsner', 'Pilsener' in style_split),
+               ('IPA', ipa),
+               ('Porter', 'Porter' in style_split),
+               ('Stout', 'Stout' in style_split),
+               ('Red/Amber Ale', red_amber_ale),
+               ('Lager', 'Lager' in style_split),
+               ('Other Ale', other_ale),
+               ('Pale Ale', pale_ale)]
+    
+    return next((name for name, match in matches if match), None)
+
 
 class Reviews:
     """
     Pipeline for generating Age column from Users and their Reviews. 
     """
-    def __init__(self, users_path, reviews_path):
+    def __init__(self, users_path, reviews_path, cache=DEFAULT_CACHE, chunk_size=None, n_workers=1, partition='year',
+                 cube_path=None):
         """
         Initialize AgeFromReviews with users path and reviews path in .csv.
         @param users_path: users .csv file path
-        @param reviews_path: reviews .csv file path
+        @param reviews_path: reviews .parquet, .csv or .pkl file path
+        @param cache: StageCache for the loaded and filtered reviews (shared by all Reviews by default, None disables it)
+        @param chunk_size: if given, the aggregations stream the reviews chunk_size rows at a time instead of loading them all
+        (.parquet and .csv reviews only, a pickle is loaded whole)
+        @param n_workers: number of processes that aggregate partitions of the reviews in parallel
+        @param partition: how the reviews are partitioned between the processes, 'year' or 'user' (hash of the user id)
+        @param cube_path: file where the aggregate cube is saved once built, and loaded from by the next sessions as long as
+        the users and reviews files are the same (built in memory on every session if None)
         """
         self.users_path = users_path
         self.reviews_path = reviews_path
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self.n_workers = n_workers
+        self.partition = partition
+        self.cube_path = cube_path
+        
+        # Cube loaded from cube_path, or with the reviews added by update (None until then), and the wide frames
+        # computed from the cube
+        self._cube = None
+        self._wide_frames = {}
+        
+    def load_us_users(self):
+        """
+        Loads the users that come from US, with their state (parsed once per user, not once per review).
+        Location is like 'United States, California' and the state is its last part.
+        """
+        
+        users_df = pd.read_csv(self.users_path, usecols=['user_id', 'joined', 'location'], dtype=csv_dtypes())
         
-    def make_age_state_cols(self):
+        # Filter out only users that come from US
+        users_df = users_df.dropna(subset=['location'])
+        us_users = users_df[users_df['location'].str.startswith('United States')].copy()
+        us_users['state'] = us_users['location'].str.split(',').str[-1].str.strip()
+        
+        return compact_dtypes(us_users.reset_index(drop=True))
+    
+    def make_age_state_cols(self, columns=None, optional_columns=()):
         """
         Function that merges user and reviews dataframes and adds age and state columns. Users outside US are filtered out. 
         Age is approximated as 21 + (date_review - date_joining).
+        Names, ids and labels are categoricals and numbers are downcast (see reviews_schema), which makes the reviews
+        several times smaller only if the columns leave out the text (the aggregations only load RATING_COLUMNS).
+        The users are filtered before the join, which only keeps the reviews of US users (in the order of an inner merge
+        of users and reviews: by user, then by review).
+        Only the reviews without their text are cached (see _us_reviews): the text, most of the memory of the reviews,
+        is read again and joined on each call that asks for it.
+        @param columns: columns of the reviews to load (user_id and date are always loaded), all of them if None
+        @param optional_columns: columns of the reviews to load as well if the reviews have them
         """
         
-        # Load data
+        columns, text_followers = self._columns_without_text(columns)
         
-        # Different handling of pkl and csv files
-        if str(self.reviews_path).split('.')[-1] == 'csv':
-            reviews_df = pd.read_csv(self.reviews_path)
-        else:
-            reviews_df = pd.read_pickle(self.reviews_path)
-            
-        users_df = pd.read_csv(self.users_path)
+        return self._join_text(self._us_reviews(columns, optional_columns, text_followers is not None), text_followers)
+    
+    @cached_stage('users_path', 'reviews_path')
+    @instrumented('make_age_state_cols')
+    def _us_reviews(self, columns, optional_columns, review_rows=False):
+        """
+        Reviews of US users with their age and state (see make_age_state_cols).
+        @param columns: columns of the reviews to load, all of them if None
+        @param optional_columns: columns of the reviews to load as well if the reviews have them
+        @param review_rows: whether to add the position of each review in the reviews file, as a REVIEW_ROW column
+        """
         
+        # Load data (parquet, csv or pkl), only the requested columns are read
+        reviews_df = load_reviews(self.reviews_path, columns, optional_columns)
+        if review_rows:
+            reviews_df[REVIEW_ROW] = np.arange(len(reviews_df))
         
-        # Merge 2 dfs and approximate age
-        merged_df = pd.merge(users_df[['user_id', 'joined', 'location']], reviews_df, on='user_id', how='inner')
-        merged_df['age'] = (merged_df['date'] - merged_df['joined']) / (365.25 * 24 * 60 * 60) + 21
+        return self.join_us_users(reviews_df, self.load_us_users())
+    
+    def _columns_without_text(self, columns):
+        """
+        Columns of the reviews to load for make_age_state_cols and filter_beer_type (user_id and date are always loaded),
+        without the text if it is asked for, and the columns that come after the text, which is then joined by _join_text
+        (None if the text is not asked for, or if the reviews are a pickle, which is loaded whole anyway).
+        @param columns: columns asked for, all of them if None
+        """
         
-        # Filter out only users that come from US
-        merged_df = merged_df.dropna(subset=['location'])
-        merged_us = merged_df[merged_df['location'].str.startswith('United States')]
+        if columns is not None:
+            columns = list(dict.fromkeys(['user_id', 'date'] + list(columns)))
+        
+        requested = reviews_columns(self.reviews_path) if columns is None else columns
+        if requested is None or 'text' not in requested:
+            return columns, None
         
-        merged_us_state = merged_us.copy()
-        merged_us_state['state'] = merged_us['location'].str.split(',').str[-1].str.strip()
+        position = requested.index('text')
+        
+        return requested[:position] + requested[position + 1:], requested[position + 1:]
+    
+    def _join_text(self, us_reviews, text_followers):
+        """
+        Replaces the REVIEW_ROW column of the reviews by their text (read from the reviews file at these positions),
+        before the first of text_followers that the reviews have (before the age if none).
+        @param us_reviews: reviews from _us_reviews or _us_style_reviews
+        @param text_followers: columns that come after the text (see _columns_without_text), None if the text is not asked for
+        """
+        
+        if text_followers is None:
+            return us_reviews
+        
+        text = load_reviews(self.reviews_path, ['text'])['text']
+        rows = us_reviews.pop(REVIEW_ROW).to_numpy()
+        following = [column for column in text_followers if column in us_reviews.columns] + ['age']
+        us_reviews.insert(us_reviews.columns.get_loc(following[0]), 'text', text.iloc[rows].set_axis(us_reviews.index))
+        
+        return us_reviews
+    
+    def join_us_users(self, reviews_df, us_users):
+        """
+        Keeps the reviews of US users and adds their join date, location, age, state and year (see make_age_state_cols).
+        @param reviews_df: reviews (or a chunk of them)
+        @param us_users: users from US, from load_us_users
+        """
+        
+        # Semi-join on integer codes: position of the user of each review among the US users (-1 for other users),
+        # only the distinct user ids are compared as strings
+        user_positions = pd.Categorical(reviews_df['user_id'], categories=us_users['user_id'].astype(str)).codes
+        
+        # Reviews of US users, grouped by user like pd.merge(users, reviews, how='inner') does
+        review_rows = np.flatnonzero(user_positions >= 0)
+        review_rows = review_rows[np.argsort(user_positions[review_rows], kind='stable')]
+        user_rows = user_positions[review_rows]
+        
+        merged_us_state = pd.concat([us_users[['user_id', 'joined', 'location']].take(user_rows).reset_index(drop=True),
+                                     reviews_df.drop(columns='user_id').take(review_rows).reset_index(drop=True)], axis=1)
+        
+        # Approximate age
+        merged_us_state['age'] = (merged_us_state['date'] - merged_us_state['joined']) / (365.25 * 24 * 60 * 60) + 21
+        merged_us_state['state'] = us_users['state'].take(user_rows).to_numpy()
         
         # Add another column year
         column = pd.to_datetime(merged_us_state['date'], unit='s').dt.year
         merged_us_state['year'] = column
         
-        return merged_us_state
+        return compact_dtypes(merged_us_state)
     
-    def filter_beer_type(self):
+    def filter_beer_type(self, columns=None, optional_columns=()):
         """
         Filter beer types of interest. 
         Particularly: Pale Ale, Red/Amber Ale, IPA, Other Ales, Lager, Pilsener, Stout, Porter.
+        Like make_age_state_cols, only the reviews without their text are cached.
+        @param columns: columns of the reviews to load (see make_age_state_cols), all of them if None
+        @param optional_columns: columns of the reviews to load as well if the reviews have them
         """
         
-        us_users_reviews = self.make_age_state_cols()
+        columns, text_followers = self._columns_without_text(None if columns is None else list(columns) + ['style'])
         
-        list_store_pa = set()
-        list_store_lager = set()
-        list_store_ipa = set()
-        list_store_raa = set()
-        list_store_stout = set()
-        list_store_porter = set()
-        list_store_ale = set()
-        list_store_pilsener = set()
-
-        for style in us_users_reviews['style']:
-            style_split = style.split(' ')
+        return self._join_text(self._us_style_reviews(columns, optional_columns, text_followers is not None),
+                               text_followers)
     
-            # Pale Ale
-            if 'Ale' in style_split and 'Pale' in style_split and 'India' not in style_split:
-                list_store_pa.add(style)
-    
-            # Lager
-            if 'Lager' in style_split:
-                list_store_lager.add(style)
+    @cached_stage('users_path', 'reviews_path')
+    @instrumented('filter_beer_type')
+    def _us_style_reviews(self, columns, optional_columns, review_rows=False):
+        """
+        Reviews of US users of the beer types of interest (see filter_beer_type).
+        @param columns: columns of the reviews to load, all of them if None
+        @param optional_columns: columns of the reviews to load as well if the reviews have them
+        @param review_rows: whether to add the position of each review in the reviews file (see _us_reviews)
+        """
         
-            # IPA
-            if 'IPA' in style_split or ('India' in style_split and 'Pale' in style_split and 'Ale' in style_split):
-                list_store_ipa.add(style)
-
-            # Amber or Red Ale
-            if 'Ale' in style_split and ('Amber' in style_split or 'Red' in style_split):
-                list_store_raa.add(style)
-
-            # Stout
-            if 'Stout' in style_split:
-                list_store_stout.add(style)
-
-            # Porter
-            if 'Porter' in style_split:
-                list_store_porter.add(style)
-
-            # Pilsener
-            if 'Pilsener' in style_split:
-                list_store_pilsener.add(style)
-                
-            # Other Ale
-            if 'Ale' in style_split:
-                list_store_ale.add(style)
-            
-        # Remove IPA, Pale Ale and Red/Amber Ale from other Ales
-        list_store_ale -= list_store_ipa
-        list_store_ale -= list_store_raa
-        list_store_ale -= list_store_pa
+        return self.add_general_style(self._us_reviews(columns, optional_columns, review_rows))
+    
+    def add_general_style(self, us_users_reviews):
+        """
+        Keeps the reviews of the beer types of interest and adds their general style (see filter_beer_type).
+        @param us_users_reviews: reviews of US users (or a chunk of them)
+        """
         
-        # Add all lists together
-        all_analyzed_reviews = list_store_pa | list_store_ale | list_store_lager | list_store_raa | list_store_stout | list_store_porter | list_store_ipa | list_store_pilsener
+        # Classify each distinct style once (there are only about a hundred), then map the style codes of the reviews
+        # (the extra last entry of the lookup is for missing styles, which have code -1)
+        styles = us_users_reviews['style'].astype('category')
+        lookup = np.array([GENERAL_STYLES.index(general_style(style)) if general_style(style) is not None else -1
+                           for style in styles.cat.categories] + [-1], dtype=np.int8)
+        codes = lookup[styles.cat.codes.to_numpy()]
         
-        # Filter to keep only the reviews which style is in this predefined set
-        filtered_reviews = us_users_reviews[us_users_reviews['style'].isin(all_analyzed_reviews)]
+        # Filter to keep only the reviews which style is in one of the general styles
+        analyzed = codes >= 0
+        filt_new = us_users_reviews[analyzed].copy()
         
         # We want to add general style category - for later aggregation
-        style_mapping = {
-            **dict.fromkeys(list_store_pa, 'Pale Ale'),
-            **dict.fromkeys(list_store_ale, 'Other Ale'),
-            **dict.fromkeys(list_store_lager, 'Lager'),
-            **dict.fromkeys(list_store_raa, 'Red/Amber Ale'),
-            **dict.fromkeys(list_store_stout, 'Stout'),
-            **dict.fromkeys(list_store_porter, 'Porter'),
-            **dict.fromkeys(list_store_ipa, 'IPA'),
-            **dict.fromkeys(list_store_pilsener, 'Pilsner')
-        }
-        
-        filt_new = filtered_reviews.copy()
-        filt_new['general_style'] = filtered_reviews['style'].apply(lambda x: style_mapping.get(x, 'Other'))
+        filt_new['general_style'] = pd.Categorical.from_codes(codes[analyzed], categories=GENERAL_STYLES)
         
         return filt_new
     
+    def cube(self):
+        """
+        Aggregate cube of the reviews, with the reviews added by update if any (see build_cube).
+        With a cube_path, the cube is loaded from it once per object, or built and saved there if it is missing
+        or was built from other files.
+        """
+        
+        if self._cube is None and self.cube_path is not None:
+            self._cube = self.load_cube()
+        
+        return self._cube if self._cube is not None else self.build_cube()
+    
+    def load_cube(self):
+        """
+        Loads the cube saved at cube_path, building (and saving) it if it is missing or was built from other files.
+        """
+        
+        if os.path.exists(self.cube_path):
+            cube = ReviewsCube.load(self.cube_path, source=self._cube_source())
+            if cube is not None:
+                return cube
+        
+        # Copy of the cached cube, which stays the cube of the files while this one may be updated
+        cube = self.build_cube().copy()
+        cube.save(self.cube_path, source=self._cube_source())
+        
+        return cube
+    
+    def _cube_source(self):
+        """
+        Identity of the files the cube is built from.
+        """
+        
+        return [file_identity(self.users_path), file_identity(self.reviews_path)]
+    
+    @cached_stage('users_path', 'reviews_path', setting_attributes=('chunk_size', 'n_workers', 'partition'))
+    @instrumented('aggregation', rows=lambda cube: int(cube.cells['n_reviews'].sum()), workers='n_workers')
+    def build_cube(self):
+        """
+        Aggregate cube of the US reviews per state, year, general style and sentiment label (see ReviewsCube), built in one pass.
+        All the aggregations below are answered from it.
+        If chunk_size is set, the reviews are streamed and each chunk gives a partial cube, folded into the cube of the previous
+        chunks as it arrives, so memory is bounded by the chunk size and the size of the cube (the numbers are the same, up to
+        the rounding of the sums of ratings). Only .parquet and .csv reviews are streamed: a pickle (e.g. reviews2_df.pkl of
+        the sentiment analysis) can only be loaded whole before it is cut into chunks.
+        If n_workers > 1, the reviews (or each chunk) are partitioned (see partition_reviews) and the partial cubes
+        of the partitions are computed in a process pool.
+        """
+        
+        if self.chunk_size is None and self.n_workers == 1:
+            reviews_style = self.filter_beer_type(RATING_COLUMNS, optional_columns=['sentiment_label'])
+            return ReviewsCube.from_reviews(reviews_style)
+        
+        if self.chunk_size is None:
+            chunks = [load_reviews(self.reviews_path, RATING_COLUMNS, optional_columns=['sentiment_label'])]
+        else:
+            chunks = iter_review_chunks(self.reviews_path, RATING_COLUMNS, self.chunk_size, optional_columns=['sentiment_label'])
+        us_users = self.load_us_users()
+        
+        if self.n_workers == 1:
+            return ReviewsCube.combine(self.partial_cube(reviews_df, us_users) for reviews_df in chunks)
+        
+        # Partitions of every chunk, aggregated in a process pool (the US users are sent once to each process)
+        tasks = ((self.users_path, self.reviews_path, part)
+                 for reviews_df in chunks for part in self.partition_reviews(reviews_df))
+        
+        return ReviewsCube.combine(map_parallel(_partition_cube, tasks, self.n_workers,
+                                                initializer=_set_worker_us_users, initargs=(us_users,)))
+    
+    def update(self, new_reviews_df):
+        """
+        Folds new reviews (e.g. a new month of reviews) into the aggregates, without going over the previous ones again.
+        The cube is updated in place, and the wide frames that were already computed (aggregate_preferences_year and
+        sentiment_to_wide) are patched where the new reviews change them, in time proportional to the number of new reviews.
+        They are only rebuilt from the cube if the new reviews add a row or a column to them (e.g. a new year).
+        The reviews files are not changed: the aggregations of this object (everything answered from the cube) include the
+        new reviews from now on, but the review-level outputs (make_age_state_cols, filter_beer_type) do not.
+        With a cube_path, the updated cube is saved there, so the next sessions start from it instead of the full history,
+        until the reviews file changes (e.g. the new reviews are appended to it), which builds the cube from the files again.
+        @param new_reviews_df: new reviews, with at least the RATING_COLUMNS (and sentiment_label if the reviews have it)
+        """
+        
+        delta = self.partial_cube(new_reviews_df, self.load_us_users())
+        
+        # Copy of the cached cube, which stays the cube of the files (unless the cube was loaded from cube_path)
+        if self._cube is None:
+            self._cube = self.cube().copy() if self.cube_path is None else self.cube()
+        
+        keys = delta.cells.index.droplevel('sentiment_label').unique()
+        before = self._cube.lookup(keys)
+        self._cube.add(delta)
+        after = self._cube.lookup(keys)
+        
+        for key, (cube, wide_df) in list(self._wide_frames.items()):
+            values, years, all_states = key
+            wide_df = self._patch_wide(wide_df, values, years, all_states, before, after)
+            if wide_df is not None:
+                self._wide_frames[key] = (self._cube, wide_df)
+            else:
+                del self._wide_frames[key]
+        
+        if self.cube_path is not None:
+            self._cube.save(self.cube_path, source=self._cube_source())
+    
+    def _patch_wide(self, wide_df, values, years, all_states, before, after):
+        """
+        Sets the values of the (state, year, general style) keys changed by update in a wide frame.
+        Returns None if the frame has to be rebuilt: a value is not in its rows or columns, or, for the sentiment,
+        a key gets its first labelled review (the order of the years of sentiment_to_wide depends on them).
+        """
+        
+        changed = after[after['year'].isin(years)]
+        if not all_states:
+            changed = changed[changed['state'].isin(OVERLAPPING_STATES)]
+        
+        if values == 'avg_rating':
+            changed = changed[changed['avg_rating'].notna()]
+            new_values = changed['avg_rating']
+        else:
+            changed = changed[changed['n_positive'] + changed['n_negative'] > 0]
+            was_labelled = before.set_index(['state', 'year', 'general_style'])[['n_positive', 'n_negative']].sum(axis=1) > 0
+            was_labelled = was_labelled.reindex(pd.MultiIndex.from_frame(changed[['state', 'year', 'general_style']]),
+                                                fill_value=False)
+            if not was_labelled.all():
+                return None
+
+            negative = changed['n_negative'] / (changed['n_negative'] + changed['n_positive'])
+            new_values = negative if values == 'NEGATIVE' else 1 - negative
+        
+        rows = wide_df.index.get_indexer(changed['state'].astype(str))
+        columns = wide_df.columns.get_indexer([f"{style}_{year}" for style, year in zip(changed['general_style'], changed['year'])])
+        if (rows < 0).any() or (columns < 0).any():
+            return None
+        
+        for row, column, value in zip(rows, columns, new_values):
+            wide_df.iat[row, column] = value
+        
+        return wide_df
+    
+    def partial_cube(self, reviews_df, us_users):
+        """
+        Aggregate cube of a part of the reviews (a chunk or a partition), to be combined with the cubes of the other parts.
+        @param reviews_df: part of the reviews, with the RATING_COLUMNS
+        @param us_users: users from US, from load_us_users
+        """
+        
+        return ReviewsCube.from_reviews(self.add_general_style(self.join_us_users(reviews_df, us_users)))
+    
+    def partition_reviews(self, reviews_df):
+        """
+        Splits reviews into partitions for the parallel aggregation, keeping their order within each partition.
+        By year, every cell of the cube is computed in one process from the same reviews, in the same order, as in the
+        serial path, so the cube is exactly the same. By user (hash of the user id, 4 partitions per process, for balance
+        when there are few years), the cells are split between processes: the counts are the same, the sums of ratings
+        are the same up to rounding.
+        @param reviews_df: reviews (or a chunk of them)
+        """
+        
+        if self.partition == 'year':
+            keys = pd.to_datetime(reviews_df['date'], unit='s').dt.year.to_numpy()
+        elif self.partition == 'user':
+            keys = pd.util.hash_pandas_object(reviews_df['user_id'], index=False).to_numpy() % (4 * self.n_workers)
+        else:
+            raise ValueError(f"Unknown partition {self.partition}, use 'year' or 'user'.")
+        
+        for _, part in reviews_df.groupby(keys, sort=True):
+            yield part
+    
     def aggregate_preferences_year(self, years, all_states=False):
         """
         Aggregate preferences for the specified year for beer styles that we identified.
@@ -142,41 +433,30 @@ class Reviews:
             @merged_df (pd.DataFrame): DataFrame of described structure.
         """
         
-        # Add general style to reviews from US reviews
-        reviews_style = self.filter_beer_type()
+        # Overlapping states for all years, or all the states
+        states = None if all_states else OVERLAPPING_STATES
         
-        # Group by year, state and style for average rating 
-        results_groupped_by = reviews_style.groupby(by=['state', 'year', 'general_style'], group_keys=False).agg(avg_rating=pd.NamedAgg(column='rating', aggfunc='mean')).reset_index()
-        
-        # Overlapping states for all years 
-        if not all_states:
-            states = ['New York', 'California', 'New Hampshire', 'Wisconsin', 'Nevada', 'Pennsylvania', 'Virginia', 'Ohio', 'Florida', 'North Carolina', 'Arizona', 'Indiana', 'Georgia', 'Texas', 'South Carolina', 'Iowa', 'Kentucky']
-            # Extract reviews coming from these states and from the specified year 
-            filter_states = results_groupped_by[results_groupped_by['state'].isin(states)]
-        else:
-            # We use all the states
-            filter_states = results_groupped_by
-            
-        # For mergining
-        merged_df = None
-        
-        for year in years:
-            
-            filter_year = filter_states[filter_states['year'] == year].drop(columns=['year'])
-            filter_year_pivot = pd.pivot_table(filter_year, values='avg_rating', index='state', columns='general_style')
-        
-            # Rename columns
-            columns = filter_year_pivot.columns
-            filter_year_pivot.columns = [f"{col}_{year}" for col in columns] 
-            
-            if merged_df is None:
-                merged_df = filter_year_pivot
-                
-            else:
-                # Merge with the existing merged_df on 'state'
-                merged_df = pd.merge(merged_df, filter_year_pivot, on='state', how='outer')
-             
-        return merged_df 
+        return self._wide_frame(('avg_rating', tuple(years), all_states), lambda cube: cube.average_ratings(years, states))
+
+    def aggregate_ratings_users(self, years, all_states=False):
+        """
+        Average rating per state, year and beer style, with the number of reviews and the approximate number of distinct users
+        behind it (from the sketches of the cube, about 3% relative error), since a few users can make most of the reviews of a state.
+
+        Args:
+            @years (list): Contains range of years that we're filtering out our data on.
+            @all_states (bool): Tells whether we need all states or only subset of them.
+
+        Returns:
+            @ratings_users (pd.DataFrame): Columns [state, year, general_style, n_reviews, avg_rating, n_users].
+        """
+
+        # Overlapping states for all years, or all the states
+        states = None if all_states else OVERLAPPING_STATES
+
+        aggregated = self.cube().aggregate(['state', 'year', 'general_style'], states=states, years=years, users=True)
+
+        return aggregated[['state', 'year', 'general_style', 'n_reviews', 'avg_rating', 'n_users']]
         
     def posneg_sentiment_aggregation_counts(self, all_states):
         """
@@ -189,33 +469,10 @@ class Reviews:
             @filter_states (pd.DataFrame): Each row contains columns [state, beer_style, year, POSITIVE, NEGATIVE] i.e. what was the fraction of reviews with positive and negative sentiment for that beer style in that state in that year.
         """
         
-        # Add general style to reviews from US reviews with sentiment
-        reviews_style = self.filter_beer_type()
-        
-        # Group by state, year, style and sentiment_label (positive / negative) and count per each
-        reviews_style_grouped_by = reviews_style.groupby(by=['state', 'year', 'general_style', 'sentiment_label'], group_keys=True).size().reset_index(name='count')
-        
-        # Move sentiment_label to columns
-        pivot = pd.pivot_table(reviews_style_grouped_by, values='count', index=['state', 'year', 'general_style'], columns='sentiment_label').reset_index()
-        
-        # Fill NaN values with 0
-        fill_nan = pivot.fillna(value=0)
+        # Overlapping states for all years, or all the states
+        states = None if all_states else OVERLAPPING_STATES
         
-        # Normalize count of positive and negative labels
-        fill_nan['NEGATIVE'] = fill_nan['NEGATIVE'] / (fill_nan['NEGATIVE'] + fill_nan['POSITIVE'])
-        fill_nan['POSITIVE'] = 1 - fill_nan['NEGATIVE']
-        
-        # Boolean to chose states
-        if not all_states:
-            states = ['New York', 'California', 'New Hampshire', 'Wisconsin', 'Nevada', 'Pennsylvania', 'Virginia', 'Ohio', 'Florida', 'North Carolina', 'Arizona', 'Indiana', 'Georgia', 'Texas', 'South Carolina', 'Iowa', 'Kentucky']
-            # Extract reviews coming from these states and from the specified year 
-            filter_states = fill_nan[fill_nan['state'].isin(states)]
-            
-        else:
-            # Use all states
-            filter_states = fill_nan
-            
-        return filter_states
+        return self.cube().sentiment_fractions(states)
     
     def sentiment_to_wide(self, sentiment_drop, sentiment_keep, all_states, year_list):
         """ 
@@ -232,33 +489,48 @@ class Reviews:
         
         """
         
-        per_sentiment = self.posneg_sentiment_aggregation_counts(all_states)
-        per_sentiment_filt = per_sentiment[per_sentiment['year'].isin(year_list)]
+        states = None if all_states else OVERLAPPING_STATES
         
-        # Extract sentiment of interest
-        sentiment_interest = per_sentiment_filt.drop(columns=sentiment_drop)
-        years = sentiment_interest['year'].value_counts().index
-        
-        merged_df = None
-        
-        for year in years:
+        def build(cube):
+            per_sentiment = cube.sentiment_fractions(states)
+            per_sentiment_filt = per_sentiment[per_sentiment['year'].isin(year_list)]
             
-            filter_year = sentiment_interest[sentiment_interest['year'] == year].drop(columns=['year'])
-            filter_year_pivot = pd.pivot_table(filter_year, values=sentiment_keep, index='state', columns='general_style')
-        
-            # Rename columns
-            columns = filter_year_pivot.columns
-            filter_year_pivot.columns = [f"{col}_{year}" for col in columns] 
+            # Extract sentiment of interest
+            sentiment_interest = per_sentiment_filt.drop(columns=sentiment_drop)
+            years = sentiment_interest['year'].value_counts().index
             
-            if merged_df is None:
-                merged_df = filter_year_pivot
-                
-            else:
-                # Merge with the existing merged_df on 'state'
-                merged_df = pd.merge(merged_df, filter_year_pivot, on='state', how='outer')
-             
-        return merged_df 
+            return to_wide(sentiment_interest, sentiment_keep, years)
         
+        return self._wide_frame((sentiment_keep, tuple(year_list), all_states), build)
+    
+    def _wide_frame(self, key, build):
+        """
+        Wide frame computed from the cube by build, kept (per key) as long as the cube is the same, and patched by update.
+        """
         
+        cube = self.cube()
+        if key not in self._wide_frames or self._wide_frames[key][0] is not cube:
+            self._wide_frames[key] = (cube, build(cube))
         
-        
\ No newline at end of file
+        return cache_copy(self._wide_frames[key][1])
+
+
+# US users of the parallel aggregation, set once in each worker process by _set_worker_us_users
+_worker_us_users = None
+
+
+def _set_worker_us_users(us_users):
+    """
+    Initializer of the worker processes of the parallel aggregation: keeps the US users for all the partitions.
+    """
+    
+    global _worker_us_users
+    _worker_us_users = us_users
+
+
+def _partition_cube(users_path, reviews_path, reviews_df):
+    """
+    Worker of the parallel aggregation (module level, so that it can be pickled): cube of one partition of the reviews.
+    """
+    
+    return Reviews(users_path, reviews_path, cache=None).partial_cube(reviews_df, _worker_us_users)
@@ -0,0 +1,96 @@
+import pandas as pd
+import pyarrow as pa
+
+# Text columns with few distinct values compared to the number of reviews (names, ids, labels):
+# kept as categoricals, i.e. one small integer code per review and each distinct string stored once
+CATEGORICAL_COLUMNS = ['beer_name', 'brewery_name', 'style', 'user_name', 'user_id', 'location', 'state',
+                       'general_style', 'sentiment_label']
+
+# Numeric columns, downcast to the smallest type that holds them
+# (dates stay int64 unix times, and user join dates float64, since the age is computed from their difference)
+NUMERIC_TYPES = {'beer_id': 'int32',
+                 'brewery_id': 'int32',
+                 'date': 'int64',
+                 'year': 'int32',
+                 'abv': 'float32',
+                 'appearance': 'float32',
+                 'aroma': 'float32',
+                 'palate': 'float32',
+                 'taste': 'float32',
+                 'overall': 'float32',
+                 'rating': 'float32',
+                 'age': 'float32',
+                 'sentiment_score': 'float32'}
+
+# Date columns, as datetime64 in seconds in memory (8 bytes per review, instead of a Python date object, which the
+# date32 type of the columnar files otherwise comes back as)
+DATETIME_COLUMNS = ['readable_date']
+
+# Other columns of the parsed reviews in the columnar (.parquet) output
+# (the text, most of the memory of the reviews, has no compact type: the merged US reviews are about 7x smaller than with
+# object and 64 bit columns without it, but less than 2x with it, so the aggregations never load it, see RATING_COLUMNS)
+ARROW_TYPES = {'text': pa.string(), 'readable_date': pa.date32()}
+
+
+def arrow_type(column):
+    """
+    Type of a column in the columnar (.parquet) files, consistent with the in-memory types of compact_dtypes.
+
+    Args:
+        column (str): Name of the column.
+
+    Return:
+        type (pa.DataType): Arrow type of the column (categoricals are dictionary encoded).
+    """
+
+    if column in CATEGORICAL_COLUMNS:
+        return pa.dictionary(pa.int32(), pa.string())
+    if column in NUMERIC_TYPES:
+        return pa.from_numpy_dtype(NUMERIC_TYPES[column])
+    return ARROW_TYPES.get(column, pa.string())
+
+
+def csv_dtypes():
+    """
+    Types to pass to pd.read_csv (dtype=...), so that the columns are compact as soon as they are read.
+    Integer columns are left out, since they can have missing values in a .csv file (see compact_dtypes).
+
+    Return:
+        dtypes (dict): Column name -> dtype.
+    """
+
+    dtypes = dict.fromkeys(CATEGORICAL_COLUMNS, 'category')
+    dtypes.update({column: dtype for column, dtype in NUMERIC_TYPES.items() if dtype.startswith('float')})
+
+    return dtypes
+
+
+def compact_dtypes(df):
+    """
+    Converts the columns of a reviews (or users) DF that are in the schema to their compact type, in place.
+    Integer columns with missing values keep their type.
+
+    Args:
+        df (pd.DataFrame): DF to convert.
+
+    Return:
+        df (pd.DataFrame): The same DF.
+    """
+
+    for column in df.columns.intersection(CATEGORICAL_COLUMNS):
+        if not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+
+    for column in df.columns.intersection(list(NUMERIC_TYPES)):
+        dtype = NUMERIC_TYPES[column]
+        if df[column].dtype == dtype:
+            continue
+        values = pd.to_numeric(df[column], errors='coerce')
+        if dtype.startswith('float') or not values.isna().any():
+            df[column] = values.astype(dtype)
+
+    for column in df.columns.intersection(DATETIME_COLUMNS):
+        if df[column].dtype != 'datetime64[s]':
+            df[column] = pd.to_datetime(df[column], errors='coerce').astype('datetime64[s]')
+
+    return df
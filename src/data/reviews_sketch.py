@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+
+# Number of bits of the hash that pick the register, i.e. 2 ** 10 registers (1 KB) per sketch,
+# for a relative standard error of about 1.04 / sqrt(2 ** 10) = 3% on the number of distinct users
+SKETCH_PRECISION = 10
+
+SKETCH_REGISTERS = 1 << SKETCH_PRECISION
+
+
+def hash_users(user_ids):
+    """
+    64 bit hash of user ids, the same for the same id in any chunk, partition or process (categoricals are hashed by value).
+
+    Args:
+        @user_ids (pd.Series): User ids.
+
+    Returns:
+        @hashes (np.ndarray): uint64 hash of each user id.
+    """
+
+    return pd.util.hash_pandas_object(user_ids, index=False).to_numpy()
+
+
+def sketch_registers(hashes, groups, n_groups):
+    """
+    HyperLogLog sketches of the users of groups of reviews (e.g. the cells of a cube): the first SKETCH_PRECISION bits of the
+    hash of a user pick a register, which keeps the largest position of the first 1 bit among the other bits.
+    Sketches of disjoint sets of reviews are merged with their element-wise maximum.
+
+    Args:
+        @hashes (np.ndarray): uint64 hash of the user of each review (see hash_users).
+        @groups (np.ndarray): Group of each review, between 0 and n_groups - 1.
+        @n_groups (int): Number of groups.
+
+    Returns:
+        @registers (np.ndarray): uint8 array of shape (n_groups, SKETCH_REGISTERS).
+    """
+
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    register = (hashes >> np.uint64(64 - SKETCH_PRECISION)).astype(np.int64)
+    rest = hashes & np.uint64((1 << (64 - SKETCH_PRECISION)) - 1)
+    rank = (64 - SKETCH_PRECISION + 1 - _bit_length(rest)).astype(np.uint8)
+
+    registers = np.zeros(n_groups * SKETCH_REGISTERS, dtype=np.uint8)
+    np.maximum.at(registers, np.asarray(groups, dtype=np.int64) * SKETCH_REGISTERS + register, rank)
+
+    return registers.reshape(n_groups, SKETCH_REGISTERS)
+
+
+def estimate_distinct(registers):
+    """
+    Approximate number of distinct users of each sketch (HyperLogLog estimate, with linear counting for small numbers).
+
+    Args:
+        @registers (np.ndarray): Sketches, one per row (see sketch_registers).
+
+    Returns:
+        @estimates (np.ndarray): Approximate number of distinct users of each sketch.
+    """
+
+    registers = np.asarray(registers)
+    alpha = 0.7213 / (1 + 1.079 / SKETCH_REGISTERS)
+    estimates = alpha * SKETCH_REGISTERS ** 2 / np.exp2(-registers.astype(np.float64)).sum(axis=1)
+
+    # Few users: most registers are still empty, count them instead
+    empty = (registers == 0).sum(axis=1)
+    small = (estimates <= 2.5 * SKETCH_REGISTERS) & (empty > 0)
+    estimates[small] = SKETCH_REGISTERS * np.log(SKETCH_REGISTERS / empty[small])
+
+    return estimates
+
+
+def _bit_length(values):
+    """
+    Number of bits of each uint64 value (0 for 0), computed exactly by halving.
+    """
+
+    values = values.copy()
+    lengths = np.zeros(len(values), dtype=np.int64)
+    for shift in [32, 16, 8, 4, 2, 1]:
+        large = values >= np.uint64(1 << shift)
+        lengths[large] += shift
+        values[large] >>= np.uint64(shift)
+
+    return lengths + (values > 0)
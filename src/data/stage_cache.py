@@ -0,0 +1,286 @@
+import collections
+import functools
+import hashlib
+import json
+import os
+import pathlib
+import pickle
+
+import pandas as pd
+
+
+class StageCache:
+    """
+    Cache of the intermediate results (stages) of a pipeline, in memory and optionally on disk.
+    Entries are keyed on the stage, the identity of its input files (path, size and modification time) and its arguments,
+    so changing an input file or an argument never returns a stale result.
+    The least recently used entries are evicted when there are more than max_entries or max_bytes in memory,
+    or more than max_disk_bytes on disk. A result larger than max_bytes is returned but not kept in memory.
+    """
+
+    def __init__(self, max_entries=4, cache_dir=None, max_disk_bytes=8 << 30, max_bytes=1 << 30):
+        """
+        Args:
+            max_entries (int): Number of results kept in memory.
+            cache_dir (pathlib.Path): Directory where results are also pickled, memory only if None.
+            max_disk_bytes (int): Size of the pickled results above which the oldest ones are deleted.
+            max_bytes (int): Memory of the results kept in memory above which the least recently used ones are evicted.
+        """
+
+        self.max_entries = max_entries
+        self.cache_dir = pathlib.Path(cache_dir) if cache_dir is not None else None
+        self.max_disk_bytes = max_disk_bytes
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._sizes = {}
+
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def key(self, stage, input_paths, arguments):
+        """
+        Key of a result: hash of the stage name, the identity of the input files and the arguments.
+
+        Args:
+            stage (str): Name of the stage.
+            input_paths (list): Files the stage reads.
+            arguments (tuple): Arguments of the stage (must have a stable repr).
+
+        Return:
+            key (str): Hex digest identifying the result.
+        """
+
+        identities = [file_identity(path) for path in input_paths]
+
+        return hashlib.sha256(repr((stage, identities, arguments)).encode()).hexdigest()
+
+    def get_or_compute(self, stage, input_paths, arguments, compute):
+        """
+        Returns the cached result of a stage, or computes (and caches) it.
+        DataFrames are returned as copies (see cache_copy), so callers can add or modify columns without altering the cache.
+
+        Args:
+            stage (str): Name of the stage.
+            input_paths (list): Files the stage reads.
+            arguments (tuple): Arguments of the stage.
+            compute (callable): Function without arguments that computes the result.
+
+        Return:
+            result: Result of the stage.
+        """
+
+        key = self.key(stage, input_paths, arguments)
+
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            result = self._entries[key]
+        else:
+            result = self._load(key)
+            if result is None:
+                result = compute()
+                self._save(key, result)
+            self._keep(key, result)
+
+        return cache_copy(result)
+
+    def clear(self):
+        """
+        Empties the cache, in memory and on disk.
+        """
+
+        self._entries.clear()
+        self._sizes.clear()
+        if self.cache_dir is not None:
+            for path in self.cache_dir.glob('*.pkl'):
+                path.unlink()
+
+    def _keep(self, key, result):
+        """
+        Keeps a result in memory, then evicts the least recently used results above max_entries or max_bytes.
+        """
+
+        size = result_nbytes(result)
+        if size > self.max_bytes:
+            return
+
+        self._entries[key] = result
+        self._sizes[key] = size
+        while len(self._entries) > self.max_entries or sum(self._sizes.values()) > self.max_bytes:
+            evicted, _ = self._entries.popitem(last=False)
+            del self._sizes[evicted]
+
+    def _load(self, key):
+        """
+        Loads a pickled result, None if it is not on disk.
+        """
+
+        if self.cache_dir is None:
+            return None
+
+        path = self.cache_dir / f"{key}.pkl"
+        if not path.exists():
+            return None
+
+        # Touch the file, the least recently used ones are deleted first
+        os.utime(path)
+        with open(path, 'rb') as file:
+            return pickle.load(file)
+
+    def _save(self, key, result):
+        """
+        Pickles a result (written to a temporary file first, so a crash never leaves a truncated entry),
+        then deletes the least recently used results above max_disk_bytes.
+        """
+
+        if self.cache_dir is None:
+            return
+
+        path = self.cache_dir / f"{key}.pkl"
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as file:
+            pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+        entries = sorted(self.cache_dir.glob('*.pkl'), key=lambda entry: entry.stat().st_mtime_ns, reverse=True)
+        total = 0
+        for entry in entries:
+            total += entry.stat().st_size
+            if total > self.max_disk_bytes and entry != path:
+                entry.unlink()
+
+
+def copy_on_write():
+    """
+    Tells whether pandas copies on write, i.e. whether a shallow copy of a DF is safe to modify without altering the original
+    (always with pandas >= 3, with pandas 2 only if pd.options.mode.copy_on_write is set to True).
+
+    Return:
+        enabled (bool): True if copy on write is enabled.
+    """
+
+    if int(pd.__version__.split('.')[0]) >= 3:
+        return True
+    return pd.options.mode.copy_on_write is True
+
+
+def cache_copy(result):
+    """
+    Copy of a cached DataFrame or Series handed to a caller: shallow (no data copied) under copy on write, deep otherwise.
+    Other results are returned as they are.
+
+    Args:
+        result: Cached result.
+
+    Return:
+        result: Copy of the result that can be modified without altering the cached one.
+    """
+
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return result.copy(deep=not copy_on_write())
+    return result
+
+
+def result_nbytes(result):
+    """
+    Memory used by a result: deep memory usage of DataFrames and Series (strings included), nbytes of arrays and of objects
+    that report it (e.g. ReviewsCube), and the sum over the items of tuples, lists and dicts.
+
+    Args:
+        result: Result of a stage.
+
+    Return:
+        nbytes (int): Memory of the result in bytes (0 if unknown).
+    """
+
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return int(result.memory_usage(deep=True).sum()) if isinstance(result, pd.DataFrame) else int(result.memory_usage(deep=True))
+    if isinstance(result, (tuple, list)):
+        return sum(result_nbytes(item) for item in result)
+    if isinstance(result, dict):
+        return sum(result_nbytes(item) for item in result.values())
+    return int(getattr(result, 'nbytes', 0))
+
+
+def file_identity(path):
+    """
+    Identity of a file: its resolved path, size and modification time, which change when the file is replaced or written to.
+
+    Args:
+        path (pathlib.Path): Path of the file.
+
+    Return:
+        identity (tuple): (path, size in bytes, modification time in ns).
+    """
+
+    status = os.stat(path)
+    return str(pathlib.Path(path).resolve()), status.st_size, status.st_mtime_ns
+
+
+# File of a store derived from a source file (e.g. the text or token store of the reviews) with the identity of the source
+SOURCE_STAMP = 'source.json'
+
+
+def is_built_from(store_path, source_path):
+    """
+    Tells whether a store directory was completely built from the current version of a source file (see mark_built_from).
+
+    Args:
+        store_path (pathlib.Path): Directory of the store.
+        source_path (pathlib.Path): Source file of the store.
+
+    Return:
+        built (bool): False if the store is missing, was interrupted or the source changed since.
+    """
+
+    try:
+        with open(pathlib.Path(store_path) / SOURCE_STAMP) as file:
+            return json.load(file) == list(file_identity(source_path))
+    except (OSError, ValueError):
+        return False
+
+
+def mark_built_from(store_path, source_path):
+    """
+    Records the identity of the source file of a store directory, once the store is completely written
+    (a store is first unmarked by deleting its SOURCE_STAMP, so that an interrupted build is built again).
+
+    Args:
+        store_path (pathlib.Path): Directory of the store.
+        source_path (pathlib.Path): Source file of the store.
+    """
+
+    with open(pathlib.Path(store_path) / SOURCE_STAMP, 'w') as file:
+        json.dump(list(file_identity(source_path)), file)
+
+
+# Cache shared by all the pipeline objects of a session (e.g. a notebook), so the raw files are loaded once,
+# holding at most 1 GB of results in memory (the review-level stages of Reviews cache their reviews without the text,
+# which is read again when it is asked for)
+DEFAULT_CACHE = StageCache()
+
+
+def cached_stage(*input_attributes, setting_attributes=()):
+    """
+    Decorator for the stage methods of a pipeline class: the result is cached in self.cache (not cached if it is None),
+    keyed on the files given by the input_attributes of the object, on its setting_attributes and on the arguments of the method.
+
+    Args:
+        input_attributes (str): Names of the attributes of the object with the paths of the files the stage reads.
+        setting_attributes (tuple): Names of the other attributes of the object the result depends on (e.g. chunk_size).
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.cache is None:
+                return method(self, *args, **kwargs)
+
+            input_paths = [getattr(self, attribute) for attribute in input_attributes]
+            arguments = (args, sorted(kwargs.items()), [getattr(self, attribute) for attribute in setting_attributes])
+
+            return self.cache.get_or_compute(method.__qualname__, input_paths, arguments,
+                                             lambda: method(self, *args, **kwargs))
+
+        return wrapper
+
+    return decorator
@@ -1,5 +1,19 @@
-import pandas as pd
-from torch.utils.data import DataLoader, Dataset, random_split
+import mmap
+import os
+import pathlib
+
+import numpy as np
+import pyarrow as pa
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler, random_split
+from src.data.load_and_parse_beeradvocate_reviews import iter_review_chunks, load_reviews
+from src.data.stage_cache import SOURCE_STAMP, is_built_from, mark_built_from
+
+# Approximate number of characters per token, to estimate the number of tokens of the reviews from their text
+CHARS_PER_TOKEN = 4
+
+# Number of reviews sorted by length together when the batches are shuffled (see LengthBucketBatchSampler)
+BUCKET_SIZE = 4096
 
 
 class TextReviews(Dataset):
@@ -10,16 +24,235 @@ class TextReviews(Dataset):
     def __init__(self, path_to_df):
         """
         Init the Dataset from the dataframe
-        @param path_to_df: path to the pickle file containing the dataframe
+        @param path_to_df: path to the .parquet, .csv or pickle file containing the dataframe
         """
         super().__init__()
-        self.df = pd.read_csv(path_to_df)
+        self.df = load_reviews(path_to_df, columns=['text'])
+        # Texts as an array, so that a sample (or a batch, see __getitems__) is a plain array indexing
+        self.texts = self.df['text'].to_numpy(dtype=object)
 
     def __len__(self):
         return len(self.df)
 
     def __getitem__(self, idx):
-        return self.df['text'].iloc[idx]
+        return self.texts[idx]
+
+    def text_lengths(self):
+        """
+        Number of characters of each text (0 if missing)
+        """
+        return self.df['text'].str.len().fillna(0).to_numpy(dtype=np.int64)
+
+    def __getitems__(self, indices):
+        """
+        Texts of a whole batch in one take (used by the DataLoader, also through the Subsets of random_split, instead of
+        calling __getitem__ for each sample)
+        @param indices: indices of the samples of the batch
+        """
+        return self.texts[np.asarray(indices, dtype=np.int64)].tolist()
+
+
+class MappedTextReviews(Dataset):
+    """
+    Dataset of the text reviews backed by a text store on disk: the UTF-8 texts one after the other (text.bin) and the byte
+    offset of each text (offsets.npy, one more than the number of reviews). Both are memory-mapped when the first item is read,
+    so creating the dataset is instant, and the DataLoader workers share the pages of the files instead of each having a copy
+    of the reviews. Missing texts are empty strings.
+    """
+
+    def __init__(self, store_path):
+        """
+        Init the Dataset from a text store (see build_store, or from_reviews to build it when needed)
+        @param store_path: directory of the text store
+        """
+        super().__init__()
+        self.store_path = pathlib.Path(store_path)
+        self._offsets = None
+        self._buffer = None
+
+    @classmethod
+    def from_reviews(cls, path_to_df, store_path, chunk_size=1_000_000):
+        """
+        Dataset of the texts of the reviews, building their text store first if it does not exist or the reviews changed
+        @param path_to_df: path to the .parquet, .csv or pickle file containing the dataframe
+        @param store_path: directory of the text store
+        @param chunk_size: number of reviews loaded at once to build the store
+        """
+        if not is_built_from(store_path, path_to_df):
+            cls.build_store(path_to_df, store_path, chunk_size)
+
+        return cls(store_path)
+
+    @classmethod
+    def build_store(cls, path_to_df, store_path, chunk_size=1_000_000):
+        """
+        Writes the text store of the reviews, loading chunk_size reviews (their text only) at a time
+        @param path_to_df: path to the .parquet, .csv or pickle file containing the dataframe
+        @param store_path: directory of the text store
+        @param chunk_size: number of reviews loaded at once
+        """
+        store_path = pathlib.Path(store_path)
+        store_path.mkdir(parents=True, exist_ok=True)
+        (store_path / SOURCE_STAMP).unlink(missing_ok=True)
+
+        offsets = [np.zeros(1, dtype=np.int64)]
+        with open(store_path / 'text.bin', 'wb') as file:
+            for reviews_df in iter_review_chunks(path_to_df, columns=['text'], chunk_size=chunk_size):
+                # Arrow string arrays already are a contiguous UTF-8 buffer and offsets
+                texts = pa.array(reviews_df['text'].astype(object).where(reviews_df['text'].notna(), ''), type=pa.large_string())
+                text_offsets = np.frombuffer(texts.buffers()[1], dtype=np.int64)[texts.offset:texts.offset + len(texts) + 1]
+                if len(texts):
+                    file.write(memoryview(texts.buffers()[2])[text_offsets[0]:text_offsets[-1]])
+                offsets.append(text_offsets[1:] - text_offsets[0] + offsets[-1][-1])
+
+        np.save(store_path / 'offsets.npy', np.concatenate(offsets))
+
+        # Written last: a store without it (e.g. interrupted) is built again
+        mark_built_from(store_path, path_to_df)
+
+    @property
+    def offsets(self):
+        """
+        Byte offsets of the texts of the store, memory-mapped on first use in each process.
+        """
+        if self._offsets is None:
+            self._offsets = np.load(self.store_path / 'offsets.npy', mmap_mode='r')
+        return self._offsets
+
+    def _text_buffer(self):
+        """
+        Texts of the store, memory-mapped on first use in each process.
+        """
+        if self._buffer is None:
+            with open(self.store_path / 'text.bin', 'rb') as file:
+                self._buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(file.fileno()).st_size else b''
+        return self._buffer
+
+    def __getstate__(self):
+        # Workers map the files themselves, the mappings of this process are not pickled
+        state = self.__dict__.copy()
+        state['_offsets'] = None
+        state['_buffer'] = None
+        return state
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def text_lengths(self):
+        """
+        Number of bytes of each text (0 if missing)
+        """
+        return np.diff(self.offsets)
+
+    def __getitem__(self, idx):
+        start, end = int(self.offsets[idx]), int(self.offsets[idx + 1])
+        return self._text_buffer()[start:end].decode('utf-8')
+
+    def __getitems__(self, indices):
+        """
+        Texts of a whole batch, with one lookup of their offsets (see TextReviews.__getitems__)
+        @param indices: indices of the samples of the batch
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        starts, ends = self.offsets[indices].tolist(), self.offsets[indices + 1].tolist()
+        buffer = self._text_buffer()
+        return [buffer[start:end].decode('utf-8') for start, end in zip(starts, ends)]
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batch sampler that puts reviews of about the same length together, with as many reviews per batch as fit in a budget of
+    tokens (number of reviews times the longest of them, i.e. the size of the batch once padded to its longest review).
+    When shuffling, the reviews are shuffled, sorted by length within buckets of bucket_size reviews, cut into batches and
+    the batches are shuffled: the batches change at each epoch but are the same for the same seed and epoch.
+    Otherwise, the reviews are sorted by length.
+    """
+
+    def __init__(self, lengths, max_tokens: int, shuffle: bool = True, seed: int = 0, bucket_size: int = BUCKET_SIZE) -> None:
+        """
+        @param lengths: number of tokens of each review (e.g. TokenIds.lengths())
+        @param max_tokens: maximum number of tokens of a batch, padding included (a longer review is alone in its batch)
+        @param shuffle: whether to shuffle the reviews and the batches at each epoch
+        @param seed: seed of the shuffling
+        @param bucket_size: number of reviews sorted by length together when shuffling
+        """
+        super().__init__()
+        self.lengths = np.maximum(np.asarray(lengths, dtype=np.int64), 1)
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.bucket_size = bucket_size
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Sets the epoch of the next iteration (the epoch is otherwise incremented at each iteration)
+        @param epoch: epoch number
+        """
+        self.epoch = epoch
+
+    def batches(self, epoch: int) -> list:
+        """
+        Batches of an epoch
+        @param epoch: epoch number
+        @return: list of the indices of the reviews of each batch
+        """
+        if self._batches is not None and self._batches[0] == epoch:
+            return self._batches[1]
+
+        if self.shuffle:
+            rng = np.random.default_rng([self.seed, epoch])
+            order = rng.permutation(len(self.lengths))
+            # sort by length within each bucket of shuffled reviews
+            order = order[np.lexsort((self.lengths[order], np.arange(len(order)) // self.bucket_size))]
+        else:
+            order = np.argsort(self.lengths, kind='stable')
+
+        batches, batch, longest = [], [], 0
+        for index, length in zip(order.tolist(), self.lengths[order].tolist()):
+            longest = max(longest, length)
+            if batch and longest * (len(batch) + 1) > self.max_tokens:
+                batches.append(batch)
+                batch, longest = [], length
+            batch.append(index)
+        if batch:
+            batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        self._batches = (epoch, batches)
+        return batches
+
+    def __iter__(self):
+        batches = self.batches(self.epoch)
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.batches(self.epoch))
+
+
+class DynamicPadding:
+    """
+    Collate function that tokenizes a batch of texts and pads it to its longest review only (instead of a fixed length)
+    """
+
+    def __init__(self, tokenizer, max_length: int = 512, pad_to_multiple_of: int = 8) -> None:
+        """
+        @param tokenizer: Hugging Face tokenizer
+        @param max_length: length the reviews are truncated to
+        @param pad_to_multiple_of: the padded length is rounded up to a multiple of it (None for no rounding)
+        """
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def __call__(self, texts):
+        texts = [text if isinstance(text, str) else '' for text in texts]
+        return self.tokenizer(texts, padding='longest', truncation=True, max_length=self.max_length,
+                              pad_to_multiple_of=self.pad_to_multiple_of, return_tensors='pt')
 
 
 class TextReviewDataLoader(DataLoader):
@@ -28,7 +261,7 @@ class TextReviewDataLoader(DataLoader):
     """
 
     def __init__(self, text_dataset: TextReviews, batch_size: int = 32, train_ratio: float = 0.8, val_ratio: float = 0.1,
-                 test_ratio: float = 0.1) -> None:
+                 test_ratio: float = 0.1, max_tokens: int = None, lengths=None, collate_fn=None, seed: int = 0) -> None:
         """
         Initialize a dataloader for each of the train, val and test datasets
         @param text_dataset: dataset containing all the text reviews
@@ -36,6 +269,12 @@ class TextReviewDataLoader(DataLoader):
         @param train_ratio: training set % of the dataset
         @param val_ratio: validation set % of the dataset
         @param test_ratio: test set % of the dataset
+        @param max_tokens: if given, batches of reviews of about the same length with at most max_tokens tokens once padded
+        (see LengthBucketBatchSampler) instead of batch_size reviews
+        @param lengths: number of tokens of each review of the dataset (e.g. TokenIds.lengths()), estimated from the length
+        of the texts if None
+        @param collate_fn: function that makes a batch from its texts (e.g. DynamicPadding), the list of texts if None
+        @param seed: seed of the split and of the shuffling
         """
         assert train_ratio + val_ratio + test_ratio == 1, "The sum of train_ratio, val_ratio and test_ratio should be equal to 1"
         total_items = len(text_dataset)
@@ -44,14 +283,34 @@ class TextReviewDataLoader(DataLoader):
         val_size = int(total_items * val_ratio)
         test_size = total_items - train_size - val_size
 
-        self.train_dataset, self.val_dataset, self.test_dataset = random_split(text_dataset, [train_size, val_size, test_size])
+        self.train_dataset, self.val_dataset, self.test_dataset = random_split(text_dataset, [train_size, val_size, test_size],
+                                                                               generator=torch.Generator().manual_seed(seed))
         self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.collate_fn = collate_fn
+        self.seed = seed
+
+        if max_tokens is not None:
+            if lengths is None:
+                lengths = text_dataset.text_lengths() // CHARS_PER_TOKEN
+            self.lengths = np.asarray(lengths)
+
+    def _dataloader(self, dataset, shuffle):
+        """
+        Dataloader of one of the train, val and test datasets
+        """
+        if self.max_tokens is None:
+            return DataLoader(dataset, batch_size=self.batch_size, shuffle=shuffle, collate_fn=self.collate_fn,
+                              generator=torch.Generator().manual_seed(self.seed) if shuffle else None)
+
+        batch_sampler = LengthBucketBatchSampler(self.lengths[dataset.indices], self.max_tokens, shuffle=shuffle, seed=self.seed)
+        return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=self.collate_fn)
 
     def train_dataloader(self):
-        return DataLoader(self.train_dataset, batch_size=self.batch_size, shuffle=True)
+        return self._dataloader(self.train_dataset, shuffle=True)
 
     def val_dataloader(self):
-        return DataLoader(self.val_dataset, batch_size=self.batch_size, shuffle=False)
+        return self._dataloader(self.val_dataset, shuffle=False)
 
     def test_dataloader(self):
-        return DataLoader(self.test_dataset, batch_size=self.batch_size, shuffle=False)
+        return self._dataloader(self.test_dataset, shuffle=False)
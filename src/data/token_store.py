@@ -0,0 +1,189 @@
+import hashlib
+import itertools
+import json
+import os
+import pathlib
+
+import numpy as np
+
+from src.data.load_and_parse_beeradvocate_reviews import iter_review_chunks
+from src.data.stage_cache import SOURCE_STAMP, file_identity, is_built_from, mark_built_from
+
+# Number of reviews given to the tokenizer at once while a store is built
+TOKENIZE_CHUNK_SIZE = 50_000
+
+
+class TokenIds:
+    """
+    Token ids of the reviews of a reviews file, for one tokenizer: the ids of all the reviews one after the other
+    (ids.bin, memory-mapped int32) and the offset of the ids of each review (offsets.npy, one more than the number of reviews).
+    Reviews are in the order of the reviews file, a review without text has no token.
+    """
+
+    def __init__(self, store_path):
+        """
+        Args:
+            store_path (pathlib.Path): Directory of the store (see TokenStore).
+        """
+
+        self.store_path = pathlib.Path(store_path)
+        self.offsets = np.load(self.store_path / 'offsets.npy', mmap_mode='r')
+
+        ids_path = self.store_path / 'ids.bin'
+        self.ids = np.memmap(ids_path, dtype=np.int32, mode='r') if os.path.getsize(ids_path) else np.zeros(0, dtype=np.int32)
+
+        vocabulary_path = self.store_path / 'vocabulary.json'
+        self.vocabulary = None
+        if vocabulary_path.exists():
+            with open(vocabulary_path) as file:
+                self.vocabulary = json.load(file)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        return self.ids[self.offsets[row]:self.offsets[row + 1]]
+
+    def lengths(self, rows=None):
+        """
+        Number of tokens of reviews.
+
+        Args:
+            rows (np.ndarray): Positions of the reviews in the reviews file, all of them if None.
+
+        Return:
+            lengths (np.ndarray): Number of tokens of each review.
+        """
+
+        lengths = np.diff(self.offsets)
+        return lengths if rows is None else lengths[rows]
+
+    def take(self, rows):
+        """
+        Token ids of reviews.
+
+        Args:
+            rows (np.ndarray): Positions of the reviews in the reviews file.
+
+        Return:
+            token_ids (list): int32 array of the ids of each review (views of the memory-mapped ids).
+        """
+
+        rows = np.asarray(rows, dtype=np.int64)
+        starts, ends = self.offsets[rows].tolist(), self.offsets[rows + 1].tolist()
+        return [self.ids[start:end] for start, end in zip(starts, ends)]
+
+    def padded(self, rows, pad_id=0):
+        """
+        Token ids of a batch of reviews, padded to the longest review of the batch, in one vectorized gather.
+
+        Args:
+            rows (np.ndarray): Positions of the reviews of the batch in the reviews file.
+            pad_id (int): Id of the padding token.
+
+        Return:
+            input_ids (np.ndarray): int64 array of shape (len(rows), longest review of the batch).
+            attention_mask (np.ndarray): int64 array of the same shape, 1 for the tokens and 0 for the padding.
+        """
+
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = np.asarray(self.offsets[rows])
+        lengths = np.asarray(self.offsets[rows + 1]) - starts
+
+        positions = np.arange(lengths.max(initial=0))
+        attention_mask = positions < lengths[:, None]
+        input_ids = np.full(attention_mask.shape, pad_id, dtype=np.int64)
+        input_ids[attention_mask] = self.ids[(starts[:, None] + positions)[attention_mask]]
+
+        return input_ids, attention_mask.astype(np.int64)
+
+
+class TokenStore:
+    """
+    Persistent token ids of the reviews, one store (see TokenIds) per tokenizer and reviews file, shared by the NLP stages
+    (sentiment analysis, sentence embeddings, LDA). A store is built the first time a tokenizer is used on a reviews file and
+    read back afterwards, so a rerun of a stage, or another model with the same tokenizer, does not tokenize the reviews again,
+    and stages that read different reviews files with the same tokenizer do not replace each other's store.
+    A store is built again if the reviews file changed (size or modification time).
+    """
+
+    def __init__(self, root_path):
+        """
+        Args:
+            root_path (pathlib.Path): Directory of the stores, one sub-directory per tokenizer and reviews file.
+        """
+
+        self.root_path = pathlib.Path(root_path)
+
+    def store_path(self, tokenizer_name, reviews_path):
+        """
+        Directory of the store of a tokenizer for a reviews file: named after the tokenizer and the reviews file
+        (its name and a hash of its resolved path, see file_identity).
+        """
+        source = file_identity(reviews_path)[0]
+        source_hash = hashlib.sha256(source.encode()).hexdigest()[:16]
+        return self.root_path / tokenizer_name.replace('/', '--') / f"{pathlib.Path(source).stem}-{source_hash}"
+
+    def tokens(self, reviews_path, tokenizer_name, tokenize, words=False, chunk_size=TOKENIZE_CHUNK_SIZE):
+        """
+        Token ids of the reviews of a reviews file, tokenized only if there is no store of the tokenizer for this file yet.
+
+        Args:
+            reviews_path (pathlib.Path): Path to the parsed reviews (.parquet, .csv or pickle).
+            tokenizer_name (str): Name of the tokenizer and its settings (e.g. its maximum length): reviews are only
+                tokenized again under another name.
+            tokenize (callable): Function of a list of texts that gives the list of the tokens of each text.
+            words (bool): Whether tokenize gives words (str), which are then numbered in a vocabulary, instead of ids.
+            chunk_size (int): Number of reviews tokenized at once.
+
+        Return:
+            token_ids (TokenIds): Token ids of the reviews, in the order of the reviews file.
+        """
+
+        store_path = self.store_path(tokenizer_name, reviews_path)
+        if not is_built_from(store_path, reviews_path):
+            self.build(reviews_path, tokenizer_name, tokenize, words, chunk_size)
+
+        return TokenIds(store_path)
+
+    def build(self, reviews_path, tokenizer_name, tokenize, words=False, chunk_size=TOKENIZE_CHUNK_SIZE):
+        """
+        Tokenizes the reviews of a reviews file and writes the store of the tokenizer for this file (replacing the previous one),
+        loading chunk_size texts at a time. Arguments are the ones of tokens.
+        The files are written to temporary files first and then replace the previous ones, which stay valid for the TokenIds
+        that still map them.
+        """
+
+        store_path = self.store_path(tokenizer_name, reviews_path)
+        store_path.mkdir(parents=True, exist_ok=True)
+        (store_path / SOURCE_STAMP).unlink(missing_ok=True)
+
+        vocabulary = {}
+        offsets = [np.zeros(1, dtype=np.int64)]
+        with open(store_path / 'ids.bin.tmp', 'wb') as file:
+            for reviews_df in iter_review_chunks(reviews_path, columns=['text'], chunk_size=chunk_size):
+                texts = reviews_df['text'].astype(object).where(reviews_df['text'].notna(), '').tolist()
+                tokens = tokenize(texts)
+                if words:
+                    tokens = [[vocabulary.setdefault(word, len(vocabulary)) for word in text_tokens] for text_tokens in tokens]
+
+                lengths = np.fromiter(map(len, tokens), dtype=np.int64, count=len(tokens))
+                ids = np.fromiter(itertools.chain.from_iterable(tokens), dtype=np.int32, count=lengths.sum())
+                file.write(ids.tobytes())
+                offsets.append(np.cumsum(lengths) + offsets[-1][-1])
+
+        with open(store_path / 'offsets.npy.tmp', 'wb') as file:
+            np.save(file, np.concatenate(offsets))
+        if words:
+            with open(store_path / 'vocabulary.json.tmp', 'w') as file:
+                json.dump(list(vocabulary), file)
+
+        os.replace(store_path / 'ids.bin.tmp', store_path / 'ids.bin')
+        os.replace(store_path / 'offsets.npy.tmp', store_path / 'offsets.npy')
+        if words:
+            os.replace(store_path / 'vocabulary.json.tmp', store_path / 'vocabulary.json')
+        else:
+            (store_path / 'vocabulary.json').unlink(missing_ok=True)
+
+        # Written last: a store without it (e.g. interrupted) is built again
+        mark_built_from(store_path, reviews_path)
@@ -1,4 +1,4 @@
-import pandas as pd
+import numpy as np
 import pathlib
 from gensim import corpora
 from gensim.models import LdaModel
@@ -9,19 +9,30 @@ from pprint import pprint
 import nltk
 from wordcloud import WordCloud
 import matplotlib.pyplot as plt
+from src.data.load_and_parse_beeradvocate_reviews import load_reviews
+from src.data.token_store import TokenStore
+from src.utils.instrumentation import instrumented
+
+# Name of the tokenization of the LDA (lower case words, without stop words, lemmatized) in the token store
+LDA_TOKENIZER = 'lda_words_lemmatized'
 
 nltk.download('stopwords')
 nltk.download('wordnet')
 
 
 class LDAAnalysis:
-    def __init__(self, reviews: list[str] = []):
+    def __init__(self, reviews: list[str] = [], token_store: TokenStore = None):
         """
         Initialize the LDA Analysis pipeline with the dataset
         The goal is to find the general topics in the reviews
         @param reviews: dataset of string reviews
+        @param token_store: store of the tokens of the reviews loaded with load_dataset, tokenized once and reused by the
+        next runs (the reviews are tokenized on each run if None)
         """
         self.dataset = reviews
+        self.token_store = token_store
+        self.reviews_df_path = None
+        self.rows = None
 
         self.stop_words = set(stopwords.words('english'))
         self.lemmatizer = WordNetLemmatizer()
@@ -31,22 +42,32 @@ class LDAAnalysis:
 
     def load_dataset(self, reviews_df_path):
         """Load the dataset """
-        reviews_df = pd.read_csv(reviews_df_path)
+        reviews_df = load_reviews(reviews_df_path, columns=['text'])
 
         # remove empty strings
-        reviews_df['text'] = reviews_df['text'].dropna()
+        keep = (reviews_df['text'].notna() & (reviews_df['text'].astype(str).str.strip() != '')).to_numpy()
+        reviews_df = reviews_df[keep]
         reviews_df['text'] = reviews_df['text'].astype(str)
-        reviews_df = reviews_df[reviews_df['text'].str.strip() != '']
 
         reviews = reviews_df['text'].tolist()
         self.dataset = reviews
+
+        # positions of the reviews in the file, i.e. in the token store
+        self.reviews_df_path = reviews_df_path
+        self.rows = np.flatnonzero(keep)
         print(f"Loaded dataset with {len(self.dataset)} reviews.")
 
+    @instrumented('lda_preprocess', rows=None)
     def preprocess(self):
         """
         Preprocess the document text by tokenizing, removing stop words, and lemmatizing
         """
         print("starting preprocess")
+        if self.token_store is not None and self.reviews_df_path is not None:
+            self._preprocess_from_token_store()
+            print("preprocessing completed")
+            return
+
         documents = [self.dataset[i] for i in range(len(self.dataset))]
         documents = self._keep_valid_string_docs(documents)
 
@@ -59,6 +80,38 @@ class LDAAnalysis:
         self.corpus = [self.dictionary.doc2bow(doc) for doc in processed_docs]
         print("preprocessing completed")
 
+    def tokenize(self, texts):
+        """
+        Words of texts, in lower case, without the stop words and lemmatized
+        @param texts: list of texts
+        """
+        tokenized_docs = [doc.lower().split() for doc in texts]
+        tokenized_docs = self._filter_out_stop_words(tokenized_docs)
+        return self._lematize(tokenized_docs)
+
+    def _preprocess_from_token_store(self):
+        """
+        Same as preprocess, with the words of the token store (the reviews are only tokenized on the first run): the words
+        are counted with one bincount of their ids and the bag of words of each review comes from its ids
+        """
+        token_ids = self.token_store.tokens(self.reviews_df_path, LDA_TOKENIZER, self.tokenize, words=True)
+        docs = token_ids.take(self.rows)
+
+        # words that occur once are removed
+        frequency = np.bincount(np.concatenate(docs) if docs else np.zeros(0, dtype=np.int32), minlength=len(token_ids.vocabulary))
+        kept_words = frequency > 1
+
+        # kept words are numbered 0, 1, ... so that the dictionary (and the topic matrices) only has the kept words
+        dictionary_ids = np.cumsum(kept_words) - 1
+
+        self.corpus = []
+        for doc in docs:
+            ids, counts = np.unique(dictionary_ids[doc[kept_words[doc]]], return_counts=True)
+            self.corpus.append(list(zip(ids.tolist(), counts.tolist())))
+        self.dictionary = corpora.Dictionary.from_corpus(
+            self.corpus, id2word={dictionary_id: token_ids.vocabulary[word_id]
+                                  for dictionary_id, word_id in enumerate(np.flatnonzero(kept_words).tolist())})
+
     def _lematize(self, tokenized_docs):
         docs = [[self.lemmatizer.lemmatize(token) for token in doc] for doc in tokenized_docs]
         return docs
@@ -79,6 +132,7 @@ class LDAAnalysis:
         docs = [[token for token in doc if frequency[token] > 1] for doc in docs]
         return docs
 
+    @instrumented('lda_training', rows=None)
     def train_lda(self):
         """
         Fit the LDA to the preprocessed data
@@ -114,9 +168,9 @@ class LDAAnalysis:
 
 if __name__ == "__main__":
     data_dir_path = pathlib.Path("../../data")
-    reviews_df_path = data_dir_path / "generated" / "reviews_df.csv"
+    reviews_df_path = data_dir_path / "generated" / "reviews_df.parquet"
 
-    lda_analysis = LDAAnalysis()
+    lda_analysis = LDAAnalysis(token_store=TokenStore(data_dir_path / "generated" / "tokens"))
     lda_analysis.load_dataset(reviews_df_path)
     lda_analysis.preprocess()
     lda_analysis.train_lda()
@@ -1,20 +1,30 @@
 import pathlib
-from transformers import pipeline
 import torch
 from transformers import DistilBertTokenizer, DistilBertForSequenceClassification
 from datasets import Dataset
-import pandas as pd
+import numpy as np
 from tqdm import tqdm
+from src.data.load_and_parse_beeradvocate_reviews import load_reviews
+from src.data.token_store import TokenStore
+from src.utils.instrumentation import INSTRUMENTATION
+
+MAX_LENGTH = 512
+BATCH_SIZE = 32
 
 
 class SentimentAnalysisPipeline:
-    def __init__(self):
+    def __init__(self, token_store: TokenStore = None):
         """
         From the generated reviews_df.pkl file (by src/data/load_and_parse_beeradvocate_reviews.py)
         produce the reviews2_df.pkl file with the sentiment scores.
         Efficient code performing batching on GPU
+        @param token_store: store of the token ids of the reviews, tokenized once and reused by the next runs
+        (the reviews are tokenized on each run if None)
         """
         self.hf_dataset = None
+        self.token_store = token_store
+        self.reviews_df_path = None
+        self.rows = None
 
         # Load Tokenizer and Pretrained Sentiment Analysis Model
         self.tokenizer = DistilBertTokenizer.from_pretrained("distilbert-base-uncased-finetuned-sst-2-english")
@@ -24,62 +34,117 @@ class SentimentAnalysisPipeline:
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         if torch.cuda.device_count() > 1:
             print(f"Using {torch.cuda.device_count()} GPUs!")
-            model = torch.nn.DataParallel(self.model)
+            self.model = torch.nn.DataParallel(self.model)
 
-        model.to(device)
+        self.device = device
+        self.model.to(device)
 
-    def load_dataset(self, reviews_df_path: str = "data/generated/reviews_df.csv"):
+    def load_dataset(self, reviews_df_path: str = "data/generated/reviews_df.parquet"):
         # remove empty strings
-        reviews_df = pd.read_csv(reviews_df_path)
-        reviews_df['text'] = reviews_df['text'].dropna()
+        reviews_df = load_reviews(reviews_df_path)
+        keep = (reviews_df['text'].notna() & (reviews_df['text'].astype(str).str.strip() != '')).to_numpy()
+        reviews_df = reviews_df[keep]
         reviews_df['text'] = reviews_df['text'].astype(str)
-        reviews_df = reviews_df[reviews_df['text'].str.strip() != '']
+
+        # positions of the reviews in the file, i.e. in the token store
+        self.reviews_df_path = reviews_df_path
+        self.rows = np.flatnonzero(keep)
 
         # convert DataFrame to Hugging Face Dataset
         self.hf_dataset = Dataset.from_pandas(reviews_df[['text']])
         self.reviews_df = reviews_df
 
+    def tokenize(self, texts):
+        """
+        Token ids of texts, as given to the model (truncated to MAX_LENGTH, not padded)
+        @param texts: list of texts
+        """
+        return self.tokenizer(texts, truncation=True, max_length=MAX_LENGTH)["input_ids"]
+
     def produce_sentiment_scores(self, dst_path: str = "data/generated/reviews2_df.pkl"):
+        if self.token_store is not None:
+            self._produce_sentiment_scores_from_token_store(dst_path)
+            return
+
         def preprocess_text(batch):
-            max_length = 512
+            max_length = MAX_LENGTH
             tokenized = self.tokenizer(batch["text"], padding=True, truncation=True, max_length=max_length)
             return {
                 "input_ids": tokenized["input_ids"],
                 "attention_mask": tokenized["attention_mask"],
             }
 
-        preprocessed_dataset = self.hf_dataset.map(preprocess_text, batched=True, batch_size=32)
+        with INSTRUMENTATION.stage('sentiment_tokenization') as stage:
+            preprocessed_dataset = self.hf_dataset.map(preprocess_text, batched=True, batch_size=BATCH_SIZE)
+            stage.rows = len(preprocessed_dataset)
 
         def analyze_sentiment(batch):
-            input_ids = torch.tensor(batch["input_ids"], dtype=torch.long, device=self.device)
-            attention_mask = torch.tensor(batch["attention_mask"], dtype=torch.long, device=self.device)
-            with torch.no_grad():
-                outputs = self.model(input_ids=input_ids, attention_mask=attention_mask)
-                logits = outputs.logits
-                predictions = torch.softmax(logits, dim=1)
-            labels = torch.argmax(predictions, dim=1).cpu().numpy()
-            scores = torch.max(predictions, dim=1).values.cpu().numpy()
-            return {
-                "sentiment_label": ["POSITIVE" if label == 1 else "NEGATIVE" for label in labels],
-                "sentiment_score": scores,
-            }
+            return self._analyze_sentiment(batch["input_ids"], batch["attention_mask"])
 
         # apply sentiment analysis in batches
-        scores_results = preprocessed_dataset.map(analyze_sentiment, batched=True, batch_size=32)
+        with INSTRUMENTATION.stage('sentiment_inference') as stage:
+            scores_results = preprocessed_dataset.map(analyze_sentiment, batched=True, batch_size=BATCH_SIZE)
+            stage.rows = len(scores_results)
 
         scores_results_df = scores_results.to_pandas()
 
-        self.reviews_df[['sentiment_label', 'sentiment_score']] = scores_results_df[['sentiment_label', 'sentiment_score']]
+        # by position: the filtered reviews do not have a range index
+        self.reviews_df[['sentiment_label', 'sentiment_score']] = scores_results_df[['sentiment_label', 'sentiment_score']].to_numpy()
+
+        # save the results
+        self.reviews_df.to_pickle(dst_path)
+
+    def _analyze_sentiment(self, input_ids, attention_mask):
+        """
+        Sentiment label and score of a batch of reviews
+        @param input_ids: token ids of the reviews, padded
+        @param attention_mask: 1 for the tokens and 0 for the padding
+        """
+        input_ids = torch.tensor(input_ids, dtype=torch.long, device=self.device)
+        attention_mask = torch.tensor(attention_mask, dtype=torch.long, device=self.device)
+        with torch.no_grad():
+            outputs = self.model(input_ids=input_ids, attention_mask=attention_mask)
+            logits = outputs.logits
+            predictions = torch.softmax(logits, dim=1)
+        labels = torch.argmax(predictions, dim=1).cpu().numpy()
+        scores = torch.max(predictions, dim=1).values.cpu().numpy()
+        return {
+            "sentiment_label": ["POSITIVE" if label == 1 else "NEGATIVE" for label in labels],
+            "sentiment_score": scores,
+        }
+
+    def _produce_sentiment_scores_from_token_store(self, dst_path):
+        """
+        Same as produce_sentiment_scores, with the token ids of the token store: the reviews are only tokenized on the first
+        run (or with another tokenizer), and each batch is padded to its longest review only
+        @param dst_path: path of the pickle with the reviews and their sentiment
+        """
+        with INSTRUMENTATION.stage('sentiment_tokenization') as stage:
+            token_ids = self.token_store.tokens(self.reviews_df_path, f"{self.tokenizer.name_or_path}_max{MAX_LENGTH}",
+                                                self.tokenize)
+            stage.rows = len(self.rows)
+
+        labels, scores = [], []
+        with INSTRUMENTATION.stage('sentiment_inference') as stage:
+            for start in tqdm(range(0, len(self.rows), BATCH_SIZE)):
+                input_ids, attention_mask = token_ids.padded(self.rows[start:start + BATCH_SIZE], self.tokenizer.pad_token_id)
+                results = self._analyze_sentiment(input_ids, attention_mask)
+                labels.extend(results["sentiment_label"])
+                scores.append(results["sentiment_score"])
+            stage.rows = len(self.rows)
+
+        self.reviews_df['sentiment_label'] = labels
+        self.reviews_df['sentiment_score'] = np.concatenate(scores) if scores else np.zeros(0, dtype=np.float32)
 
         # save the results
         self.reviews_df.to_pickle(dst_path)
 
 
 if __name__ == '__main__':
-    sentiment_pipeline = SentimentAnalysisPipeline()
     data_dir_path = pathlib.Path("../../data")
+    sentiment_pipeline = SentimentAnalysisPipeline(TokenStore(data_dir_path / 'generated' / 'tokens'))
 
-    reviews_df_path = data_dir_path / 'generated' / 'reviews_df.csv'
+    reviews_df_path = data_dir_path / 'generated' / 'reviews_df.parquet'
     dst_path = data_dir_path / 'generated' / 'reviews2_df.pkl'
 
     sentiment_pipeline.load_dataset(reviews_df_path)
@@ -6,18 +6,23 @@ import pandas as pd
 import torch
 from sentence_transformers import SentenceTransformer
 from sklearn.metrics.pairwise import cosine_similarity
+from src.data.token_store import TokenStore
+from src.utils.instrumentation import INSTRUMENTATION
 
 
 class BeerCharacteristicsAnalysisPipeline:
 
-    def __init__(self):
+    def __init__(self, token_store: TokenStore = None):
         """
         The goal is to measure how much each one of the 8 beer styles we defined from (general_style column in the generated reviews_with_similarities.pkl)
         Running this code is efficient (GPU batching) but still takes a large amount of time because there are 2 million reviews to embed.
         Checkpoint dataframe are saved in the data/generated folder.
 
         We then define manually 5 beer characteristics that we want to measure and see how much each beer style is close to each of those characteristics (cosine similarity)
+        @param token_store: store of the token ids of the reviews, tokenized once and reused by the next runs
+        (the reviews are tokenized on each run if None)
         """
+        self.token_store = token_store
         if not torch.cuda.is_available():
             raise SystemError("CUDA is not available :/")
         device = 'cuda'
@@ -40,14 +45,19 @@ class BeerCharacteristicsAnalysisPipeline:
         reviews_df = pd.read_pickle(reviews_categorized_pkl_path)
 
         # preprocessing: remove the empty strings
-        reviews_df['text'] = reviews_df['text'].dropna()
+        keep = (reviews_df['text'].notna() & (reviews_df['text'].astype(str).str.strip() != '')).to_numpy()
+        reviews_df = reviews_df[keep]
         reviews_df['text'] = reviews_df['text'].astype(str)
-        reviews_df = reviews_df[reviews_df['text'].str.strip() != '']
 
         reviews = reviews_df['text'].tolist()
 
         # change to your batch size
-        all_embeddings = self.model.encode(reviews, normalize_embeddings=True, batch_size=128, show_progress_bar=True)
+        with INSTRUMENTATION.stage('sentence_embedding') as stage:
+            if self.token_store is not None:
+                all_embeddings = self._encode_token_ids(reviews_categorized_pkl_path, np.flatnonzero(keep), batch_size=128)
+            else:
+                all_embeddings = self.model.encode(reviews, normalize_embeddings=True, batch_size=128, show_progress_bar=True)
+            stage.rows = len(reviews)
 
         reviews_df["embedding"] = list(all_embeddings)
 
@@ -55,6 +65,39 @@ class BeerCharacteristicsAnalysisPipeline:
         reviews_df.to_pickle(dst_path)
         print("saved")
 
+    def tokenize(self, texts):
+        """
+        Token ids of texts, as the sentence encoder tokenizes them (truncated to its maximum sequence length, not padded)
+        @param texts: list of texts
+        """
+        return self.model.tokenizer(texts, truncation=True, max_length=self.model.max_seq_length)["input_ids"]
+
+    def _encode_token_ids(self, reviews_path, rows, batch_size):
+        """
+        Normalized embeddings of reviews from the token ids of the token store (the reviews are only tokenized on the first run).
+        Like SentenceTransformer.encode, the reviews are embedded from the longest to the shortest, so that the reviews of
+        a batch have about the same length and little padding
+        @param reviews_path: path of the file of the reviews (the source of the token store)
+        @param rows: positions of the reviews to embed in the file
+        @param batch_size: number of reviews embedded at once
+        """
+        token_ids = self.token_store.tokens(reviews_path, f"{self.model.tokenizer.name_or_path}_max{self.model.max_seq_length}",
+                                            self.tokenize)
+
+        order = np.argsort(-token_ids.lengths(rows), kind='stable')
+        embeddings = np.zeros((len(rows), self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+        for start in range(0, len(rows), batch_size):
+            batch = order[start:start + batch_size]
+            input_ids, attention_mask = token_ids.padded(rows[batch], self.model.tokenizer.pad_token_id)
+            features = {'input_ids': torch.from_numpy(input_ids).to(self.model.device),
+                        'attention_mask': torch.from_numpy(attention_mask).to(self.model.device)}
+            with torch.no_grad():
+                batch_embeddings = self.model(features)['sentence_embedding']
+                batch_embeddings = torch.nn.functional.normalize(batch_embeddings, p=2, dim=1)
+            embeddings[batch] = batch_embeddings.cpu().numpy()
+
+        return embeddings
+
     def compute_similarities(self, embed_df_path, dst_path="reviews_with_similarities.pkl"):
         reviews_df = pd.read_pickle(embed_df_path)
 
@@ -68,7 +111,9 @@ class BeerCharacteristicsAnalysisPipeline:
             return similarities
 
         # we compute similarities for all reviews with the centroids (beer characteristics)
-        reviews_df['similarities'] = compute_characteristics_similarities(reviews_df['embedding'], self.centroids)
+        with INSTRUMENTATION.stage('similarity') as stage:
+            reviews_df['similarities'] = compute_characteristics_similarities(reviews_df['embedding'], self.centroids)
+            stage.rows = len(reviews_df)
 
         reviews_df.to_pickle(dst_path)
 
@@ -10,6 +10,8 @@ from dash.dependencies import Input, Output
 from scipy.stats import pearsonr, spearmanr
 from plotly.subplots import make_subplots
 
+from src.data.reviews_cube import ReviewsCube
+
 #=========================================================================================================================
 # .py script containing all the plotting functions
 
@@ -315,15 +317,19 @@ def plot_review_count(total_reviews, year_list):
     Create plot of total number of reviews from U.S. Users per beer style. 
     
     Args:
-        @total_reviews (pd.DataFrame): Reviews after classifying beer styles into our 8 predefined general styles by keyword matching.
+        @total_reviews (pd.DataFrame or ReviewsCube): Reviews after classifying beer styles into our 8 predefined general styles by keyword matching, or their aggregate cube (see Reviews.cube).
         @year_list (list): Year range of interest. In our case 2004-2016.
         
     Returns:
         fig (go.Fig): Plot.
     """
     
-    total_reviews_list = total_reviews[total_reviews['year'].isin(year_list)]
-    total_reviews_grouped_by_style = total_reviews_list.groupby(by=['general_style', 'year']).size().reset_index(name='count')
+    if isinstance(total_reviews, ReviewsCube):
+        # Counts are already aggregated
+        total_reviews_grouped_by_style = total_reviews.review_counts(year_list)
+    else:
+        total_reviews_list = total_reviews[total_reviews['year'].isin(year_list)]
+        total_reviews_grouped_by_style = total_reviews_list.groupby(by=['general_style', 'year'], observed=True).size().reset_index(name='count')
     sorted_df = total_reviews_grouped_by_style.sort_values(by=["year", "count"], ascending=[True, False])
     
     fig = px.bar(sorted_df, x='general_style', y='count', title='Count of Reviews by U.S. Users per Beer Style', labels={'general_style': 'Beer Style', 'counts':'Counts'}, animation_frame='year', range_y=[0, sorted_df['count'].max()])
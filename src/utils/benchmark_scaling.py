@@ -0,0 +1,174 @@
+import concurrent.futures
+import multiprocessing
+import pathlib
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.data.favourite_beers_processing import FavouriteBeers
+from src.data.generate_synthetic_data import SyntheticBeerAdvocate
+from src.data.load_and_parse_beeradvocate_reviews import BeerAdvocateParser
+from src.data.reviews_processing import Reviews
+from src.utils.instrumentation import peak_rss_mb, reset_peak_rss, rss_mb
+
+# Numbers of reviews of the synthetic datasets (the BeerAdvocate dump has about 2.5M reviews)
+SCALES = [10_000, 100_000, 1_000_000, 10_000_000, 50_000_000]
+
+# Years of the aggregations, like in the analysis
+YEARS = list(np.arange(2004, 2017, 1, dtype=int))
+
+# Ratio of the time (or memory) of a stage to its baseline above which it is reported as a regression
+REGRESSION_RATIO = 1.25
+
+
+def _paths(data_dir_path):
+    """
+    Paths of the files of a (synthetic) data directory.
+    """
+    return {'src': data_dir_path / 'BeerAdvocate' / 'reviews.txt',
+            'users': data_dir_path / 'BeerAdvocate' / 'users.csv',
+            'reviews': data_dir_path / 'generated' / 'reviews_df.parquet'}
+
+
+def _parse(paths):
+    BeerAdvocateParser().generate_result(paths['src'], paths['reviews'], engine='numpy')
+
+
+def _make_age_state_cols(paths):
+    Reviews(paths['users'], paths['reviews'], cache=None).make_age_state_cols()
+
+
+def _filter_beer_type(paths):
+    Reviews(paths['users'], paths['reviews'], cache=None).filter_beer_type()
+
+
+def _aggregate_preferences_year(paths):
+    Reviews(paths['users'], paths['reviews'], cache=None).aggregate_preferences_year(YEARS, all_states=True)
+
+
+def _aggregate_preferences_year_chunked(paths):
+    Reviews(paths['users'], paths['reviews'], cache=None, chunk_size=1_000_000).aggregate_preferences_year(YEARS, all_states=True)
+
+
+def _favourite_beers(paths):
+    favourite_beers = FavouriteBeers.from_cube(Reviews(paths['users'], paths['reviews'], cache=None).cube())
+    favourite_beers.favbeer_process_for_mapplotting()
+    favourite_beers.threefavbeer_for_barplotting()
+
+
+# Stages, in the order of the pipeline (parse writes the reviews the other stages read).
+# Each stage is run like it is called in the analysis, i.e. with the stages it depends on (e.g. filter_beer_type loads the reviews)
+STAGES = {'parse': _parse,
+          'make_age_state_cols': _make_age_state_cols,
+          'filter_beer_type': _filter_beer_type,
+          'aggregate_preferences_year': _aggregate_preferences_year,
+          'aggregate_preferences_year_chunked': _aggregate_preferences_year_chunked,
+          'favourite_beers': _favourite_beers}
+
+
+def _run_stage(stage, data_dir_path):
+    """
+    Runs one stage and measures it (in a fresh process, see run_stage).
+    """
+
+    # Peak memory from now on (on Linux, the peak is otherwise inherited from the parent process)
+    reset_peak_rss()
+
+    rss_before_mb = rss_mb()
+    start = time.perf_counter()
+    STAGES[stage](_paths(data_dir_path))
+    seconds = time.perf_counter() - start
+
+    return seconds, rss_before_mb, peak_rss_mb()
+
+
+def run_stage(stage, data_dir_path, n_reviews):
+    """
+    Times and memory-profiles one stage on a dataset. The stage runs in a fresh process, so that its peak memory is its own
+    (processes it starts itself are not counted) and no cache is shared with the other stages.
+
+    Args:
+        stage (str): Name of the stage, in STAGES.
+        data_dir_path (pathlib.Path): Data directory of the dataset (see SyntheticBeerAdvocate.generate).
+        n_reviews (int): Number of reviews of the dataset.
+
+    Return:
+        result (dict): scale, stage, seconds, reviews_per_second, peak_rss_mb (peak resident memory of the process during
+            the stage) and rss_before_mb (its resident memory before the stage, i.e. the interpreter and the imports).
+    """
+
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        seconds, rss_before_mb, peak_rss_mb = executor.submit(_run_stage, stage, data_dir_path).result()
+
+    return {'scale': n_reviews, 'stage': stage, 'seconds': seconds, 'reviews_per_second': n_reviews / seconds,
+            'peak_rss_mb': peak_rss_mb, 'rss_before_mb': rss_before_mb}
+
+
+def run_benchmark(scales, root_path, seed=0, stages=None):
+    """
+    Runs the stages on synthetic datasets of each scale. The datasets are generated (seeded) the first time only.
+
+    Args:
+        scales (list): Numbers of reviews of the datasets.
+        root_path (pathlib.Path): Directory of the synthetic datasets (one data directory per scale and seed).
+        seed (int): Seed of the datasets.
+        stages (list): Stages to run (in the order of STAGES), all of them if None.
+
+    Return:
+        results (pd.DataFrame): One row per scale and stage (see run_stage).
+    """
+
+    results = []
+    for n_reviews in scales:
+        data_dir_path = pathlib.Path(root_path) / f"{n_reviews}_seed{seed}"
+        if not _paths(data_dir_path)['users'].exists():
+            SyntheticBeerAdvocate(n_reviews, seed=seed).generate(data_dir_path)
+
+        for stage in STAGES:
+            if stages is None or stage in stages:
+                results.append(run_stage(stage, data_dir_path, n_reviews))
+                print(results[-1])
+
+    return pd.DataFrame(results)
+
+
+def find_regressions(results, baseline, ratio=REGRESSION_RATIO):
+    """
+    Compares benchmark results to a baseline (e.g. the results of the last release).
+
+    Args:
+        results (pd.DataFrame): Results of run_benchmark.
+        baseline (pd.DataFrame): Baseline results, with the same columns.
+        ratio (float): Ratio of time or peak memory to the baseline above which a stage regressed.
+
+    Return:
+        regressions (pd.DataFrame): Scale, stage, time and memory ratios of the stages that regressed.
+    """
+
+    merged = results.merge(baseline, on=['scale', 'stage'], suffixes=('', '_baseline'))
+    merged['time_ratio'] = merged['seconds'] / merged['seconds_baseline']
+    merged['memory_ratio'] = ((merged['peak_rss_mb'] - merged['rss_before_mb'])
+                              / (merged['peak_rss_mb_baseline'] - merged['rss_before_mb_baseline']).clip(lower=1))
+
+    regressed = (merged['time_ratio'] > ratio) | (merged['memory_ratio'] > ratio)
+
+    return merged.loc[regressed, ['scale', 'stage', 'time_ratio', 'memory_ratio']].reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    data_dir_path = pathlib.Path("../../data")
+    results_path = data_dir_path / 'generated' / "benchmark_results.csv"
+    baseline_path = data_dir_path / 'generated' / "benchmark_baseline.csv"
+
+    # Largest scale can be given on the command line (the 10M and 50M datasets take tens of GB of disk)
+    max_scale = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+
+    results = run_benchmark([scale for scale in SCALES if scale <= max_scale], data_dir_path / 'synthetic')
+    results.to_csv(results_path, index=False)
+
+    if baseline_path.exists():
+        regressions = find_regressions(results, pd.read_csv(baseline_path))
+        print(regressions if len(regressions) else "No regression.")
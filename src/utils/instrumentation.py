@@ -0,0 +1,205 @@
+import contextlib
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+# Environment variable with the path of the JSON lines file, to enable the instrumentation without changing the code
+INSTRUMENTATION_ENV = 'ADA_INSTRUMENTATION'
+
+
+class StageRecord:
+    """
+    Measures of one run of a stage. The code of the stage can set rows (number of rows it processed) before it ends,
+    and n_workers (number of worker processes it ran, whose memory is not in the peak of this process).
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.rows = None
+        self.n_workers = 1
+        self.start = time.time()
+        self.peak_rss_mb = 0.0
+        self._start_counter = time.perf_counter()
+
+
+# Record given to the stages when the instrumentation is disabled (setting its rows has no effect)
+_DISABLED_RECORD = StageRecord(None)
+
+
+class Instrumentation:
+    """
+    Records the wall time, rows per second and peak resident memory of the stages of the pipelines (parse, make_age_state_cols,
+    filter_beer_type, aggregation, tokenization, inference, similarity, LDA training), as JSON lines: one line per run of a stage.
+    When it is disabled, a stage only costs a check of a flag.
+    Stages can be nested: the peak memory of a stage includes the stages it runs.
+    The peak memory is the one of the process that runs the stage: for a stage that runs worker processes (n_workers > 1),
+    the memory of the workers is not included, which the record tells with peak_rss_excludes_workers.
+    """
+
+    def __init__(self, path=None):
+        """
+        Args:
+            path (pathlib.Path): JSON lines file the records are appended to, disabled if None.
+        """
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._open_records = []
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def enable(self, path):
+        """
+        Starts recording the stages to a JSON lines file (appended to if it exists).
+
+        Args:
+            path (pathlib.Path): Path of the file.
+        """
+        self.path = path
+
+    def disable(self):
+        """
+        Stops recording the stages.
+        """
+        self.path = None
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """
+        Context manager that measures the code it runs as a stage.
+
+        Args:
+            stage (str): Name of the stage.
+
+        Return:
+            record (StageRecord): Measures of the run, whose rows the stage can set.
+        """
+
+        if self.path is None:
+            yield _DISABLED_RECORD
+            return
+
+        # The peak memory of the stages already running is kept before the peak is reset for this one
+        self._update_peaks()
+        reset_peak_rss()
+
+        record = StageRecord(stage)
+        self._open_records.append(record)
+        try:
+            yield record
+        finally:
+            self._update_peaks()
+            self._open_records.remove(record)
+            self._write(record)
+
+    def _update_peaks(self):
+        """
+        Adds the peak memory since the last reset to the stages that are running.
+        """
+
+        peak = peak_rss_mb()
+        for record in self._open_records:
+            record.peak_rss_mb = max(record.peak_rss_mb, peak)
+
+    def _write(self, record):
+        """
+        Appends the line of a finished stage to the file.
+        """
+
+        seconds = time.perf_counter() - record._start_counter
+        line = {'stage': record.stage,
+                'start': record.start,
+                'seconds': seconds,
+                'rows': record.rows,
+                'rows_per_second': record.rows / seconds if record.rows is not None and seconds > 0 else None,
+                'peak_rss_mb': record.peak_rss_mb,
+                'n_workers': record.n_workers,
+                'peak_rss_excludes_workers': record.n_workers > 1,
+                'pid': os.getpid()}
+
+        path = self.path
+        if path is None:
+            return
+        with self._lock, open(path, 'a') as file:
+            file.write(json.dumps(line) + '\n')
+
+
+# Instrumentation shared by all the pipelines, enabled by setting ADA_INSTRUMENTATION (or with enable)
+INSTRUMENTATION = Instrumentation(os.environ.get(INSTRUMENTATION_ENV))
+
+
+def instrumented(stage, rows=len, workers=None):
+    """
+    Decorator that measures each call of a function (or method) as a stage of INSTRUMENTATION.
+    Put it below a caching decorator (e.g. cached_stage), so that only the calls that run the stage are recorded.
+
+    Args:
+        stage (str): Name of the stage.
+        rows (callable): Function of the result of the call that gives the number of rows processed (None to not count them).
+        workers (str): Name of the attribute of the object (first argument) with its number of worker processes, if any.
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not INSTRUMENTATION.enabled:
+                return function(*args, **kwargs)
+
+            with INSTRUMENTATION.stage(stage) as record:
+                if workers is not None:
+                    record.n_workers = getattr(args[0], workers)
+                result = function(*args, **kwargs)
+                if rows is not None:
+                    record.rows = rows(result)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def reset_peak_rss():
+    """
+    Resets the peak resident memory of the process to its current resident memory (Linux only).
+    """
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def rss_mb():
+    """
+    Resident memory of the process in MB (VmRSS on Linux), its peak elsewhere (see peak_rss_mb).
+    """
+    return _memory_mb('VmRSS')
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of the process in MB since the last reset (VmHWM on Linux), since it started elsewhere.
+    """
+    return _memory_mb('VmHWM')
+
+
+def _memory_mb(field):
+    """
+    Memory of the process in MB from /proc/self/status on Linux, the peak resident memory of the process elsewhere
+    (ru_maxrss, in KB on Linux and in bytes on macOS).
+    """
+
+    try:
+        with open('/proc/self/status') as status:
+            return next(int(line.split()[1]) for line in status if line.startswith(field)) / (1 << 10)
+    except (OSError, StopIteration):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
@@ -0,0 +1,31 @@
+import pandas as pd
+import pytest
+
+from src.data.load_and_parse_beeradvocate_reviews import BeerAdvocateParser, iter_review_chunks, load_reviews
+from tests.test_parse_engines import REVIEW
+
+
+@pytest.mark.parametrize('engine', ['python', 'numpy'])
+def test_incremental_parquet_appends_part_files(tmp_path, engine):
+    reviews = [REVIEW.format(name=f"Beer {index}", beer_id=index, text=f"review {index}") + '\n\n' for index in range(9)]
+    src_path = tmp_path / 'reviews.txt'
+    dst_path = tmp_path / 'reviews_df.parquet'
+
+    parser = BeerAdvocateParser()
+    for end in [3, 3, 5, 9]:
+        src_path.write_text(''.join(reviews[:end]), encoding='utf-8')
+        parser.generate_result(src_path, dst_path, engine=engine, incremental=True)
+
+    # The first parse is renamed to the first part, then one part per parse that found new reviews
+    assert sorted(path.name for path in dst_path.iterdir()) == ['part-00000.parquet', 'part-00001.parquet', 'part-00002.parquet']
+
+    full_path = tmp_path / 'full.parquet'
+    parser.generate_result(src_path, full_path, engine=engine)
+    pd.testing.assert_frame_equal(load_reviews(dst_path), load_reviews(full_path))
+    chunks = list(iter_review_chunks(dst_path, chunk_size=2))
+    assert [review_id for chunk in chunks for review_id in chunk['beer_id']] == list(range(9))
+
+    # A full parse replaces the dataset directory
+    parser.generate_result(src_path, dst_path, engine=engine)
+    assert dst_path.is_file()
+    pd.testing.assert_frame_equal(load_reviews(dst_path), load_reviews(full_path))
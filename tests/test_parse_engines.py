@@ -0,0 +1,61 @@
+import pandas as pd
+import pytest
+
+from src.data.load_and_parse_beeradvocate_reviews import BeerAdvocateParser, _parse_chunk
+
+REVIEW = """beer_name: {name}
+beer_id: {beer_id}
+brewery_name: Brewery 1
+brewery_id: 1
+style: Saison / Farmhouse Ale
+abv: 6.5
+date: 1473902400
+user_name: user{beer_id}
+user_id: user{beer_id}.{beer_id}
+appearance: 3.0
+aroma: 3.5
+palate: 4.0
+taste: 3.0
+overall: 3.0
+rating: 3.22
+text: {text}"""
+
+
+def write_reviews(path, texts, trailing_newline):
+    reviews = [REVIEW.format(name=f"Beer {index}", beer_id=index, text=text) for index, text in enumerate(texts)]
+    path.write_text('\n\n'.join(reviews) + ('\n\n' if trailing_newline else ''), encoding='utf-8')
+
+
+@pytest.mark.parametrize('trailing_newline', [True, False])
+@pytest.mark.parametrize('texts', [['crisp and dry', 'malty', 'hoppy finish 42'],
+                                   ['crisp and dry', 'Brasserie Dupont, très sèche', 'bière à l\'été 🍺']])
+@pytest.mark.parametrize('suffix', ['.csv', '.parquet'])
+def test_numpy_engine_matches_python_engine(tmp_path, trailing_newline, texts, suffix):
+    src_path = tmp_path / 'reviews.txt'
+    write_reviews(src_path, texts, trailing_newline)
+
+    results = []
+    for engine in ['python', 'numpy']:
+        dst_path = tmp_path / f"reviews_{engine}{suffix}"
+        BeerAdvocateParser().generate_result(src_path, dst_path, engine=engine)
+        results.append(pd.read_csv(dst_path) if suffix == '.csv' else pd.read_parquet(dst_path))
+
+    pd.testing.assert_frame_equal(results[0], results[1])
+    assert results[1]['text'].tolist() == texts
+
+
+@pytest.mark.parametrize('trailing_newline', [True, False])
+def test_numpy_engine_matches_python_engine_on_irregular_reviews(tmp_path, trailing_newline):
+    reviews = [REVIEW.format(name=f"Beer {index}", beer_id=index, text=f"review {index}") for index in range(6)]
+    reviews[1] = reviews[1].replace('abv: 6.5\n', '')
+    reviews[2] = reviews[2].replace('style:', 'category: Ale\nstyle:')
+    reviews[3] = reviews[3].replace('beer_id: 3', 'beer_id: 3a')
+    reviews[4] = reviews[4].replace('beer_name: Beer 4', 'beer_name: Beer: 4').replace('text: review 4', 'text: a: b')
+    content = ('\n\n'.join(reviews) + ('\n\n' if trailing_newline else '')).encode('utf-8')
+
+    python_df, python_quarantine = _parse_chunk(content, engine='python')
+    numpy_df, numpy_quarantine = _parse_chunk(content, engine='numpy')
+
+    pd.testing.assert_frame_equal(python_df, numpy_df)
+    assert numpy_quarantine == python_quarantine == [reviews[3]]
+    assert numpy_df['beer_name'].tolist() == ['Beer 0', 'Beer 1', 'Beer 2', 'Beer', 'Beer 5']
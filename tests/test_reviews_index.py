@@ -0,0 +1,74 @@
+import pandas as pd
+import pytest
+
+from src.data.load_and_parse_beeradvocate_reviews import BeerAdvocateParser
+from src.data.reviews_index import ReviewsIndex
+
+REVIEW = """beer_name: Beer {beer_id}
+beer_id: {beer_id}
+brewery_name: Brewery 1
+brewery_id: 1
+style: Saison / Farmhouse Ale
+abv: 6.5
+date: {date}
+user_name: {user_id}
+user_id: {user_id}
+appearance: 3.0
+aroma: 3.5
+palate: 4.0
+taste: 3.0
+overall: 3.0
+rating: 3.22
+text: review of beer {beer_id}"""
+
+
+def test_review_numbers_are_parsed_rows(tmp_path):
+    reviews = [REVIEW.format(beer_id=1, date=1000, user_id='alice.1'),
+               REVIEW.format(beer_id=2, date='soon', user_id='bob.2'),
+               REVIEW.format(beer_id=3, date=1000, user_id='').replace('user_name: \n', ''),
+               REVIEW.format(beer_id=4, date=1000, user_id='alice.1') + '\ndate: 2000',
+               REVIEW.format(beer_id=5, date=1000, user_id='alice.1'),
+               REVIEW.format(beer_id=5, date=900, user_id='alice.1'),
+               REVIEW.format(beer_id=6, date=1000, user_id='bob.2')]
+    src_path = tmp_path / 'reviews.txt'
+    src_path.write_text('\n\n'.join(reviews) + '\n\n', encoding='utf-8')
+
+    dst_path = tmp_path / 'reviews.csv'
+    BeerAdvocateParser().generate_result(src_path, dst_path)
+    reviews_df = pd.read_csv(dst_path)
+
+    index = ReviewsIndex.build(src_path)
+    assert len(index) == len(reviews_df) == 4
+    for row, review in reviews_df.iterrows():
+        assert int(index.get(row)['beer_id']) == review['beer_id']
+        assert index.find(review['beer_id'], review['user_id'], review['date']) == row
+
+    assert index.find(4, 'alice.1', 1000) is None
+    assert index.find(5, 'alice.1', 950) is None
+    assert index.find(5, 'carol.3', 1000) is None
+
+
+def test_load_extends_the_index_with_appended_reviews(tmp_path):
+    reviews = [REVIEW.format(beer_id=beer_id, date=1000 + beer_id, user_id=f"user{beer_id % 3}.{beer_id % 3}")
+               for beer_id in range(1, 9)]
+    reviews[5] = REVIEW.format(beer_id=6, date='soon', user_id='user0.0')
+    src_path = tmp_path / 'reviews.txt'
+    index_path = tmp_path / 'reviews_index.npz'
+    src_path.write_text('\n\n'.join(reviews[:4]) + '\n\n', encoding='utf-8')
+    ReviewsIndex.build(src_path).save(index_path)
+
+    with open(src_path, 'a', encoding='utf-8') as file:
+        file.write('\n\n'.join(reviews[4:]) + '\n\n')
+
+    index = ReviewsIndex.load(index_path, src_path)
+    built = ReviewsIndex.build(src_path)
+    assert len(index) == len(built) == 7
+    for row in range(len(built)):
+        assert index.get(row) == built.get(row)
+    for beer_id in range(1, 9):
+        assert index.find(beer_id, f"user{beer_id % 3}.{beer_id % 3}", 1000 + beer_id) == \
+            built.find(beer_id, f"user{beer_id % 3}.{beer_id % 3}", 1000 + beer_id)
+
+    src_path.write_text(src_path.read_text(encoding='utf-8').replace('Beer 1', 'Beer 0'), encoding='utf-8')
+    with pytest.raises(ValueError):
+        ReviewsIndex.load(index_path, src_path)